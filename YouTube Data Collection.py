@@ -1,119 +1,209 @@
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from googleapiclient.discovery import build
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
 from googleapiclient.errors import HttpError
 from tqdm import tqdm
 import pandas as pd
 import json
-from itertools import cycle
 import os
-import isodate
 import traceback
-from datetime import datetime, timedelta
+import threading
+import time
+from datetime import datetime
+from quota import QuotaScheduler, QuotaExhaustedError
+from resilience import FailedItems, read_failed_items, body_reason
+from work_queue import WorkQueue, default_worker_id
+from api_client import ClientPool
+from metrics import metrics
+from writers import open_row_writer, output_path, output_columns, read_output_chunks, combine_comments, read_latest_comments, merge_outputs
+from checkpoint import ProgressJournal
+from item_cache import ItemCache
+from async_collector import run_async_collection
+from youtube_items import chunk_list, in_date_range, build_video_details, build_comment_details, build_reply_details, build_channel_details, is_known_comment, build_statistics_rows
 #from translate import translate_en
 
 # Load API keys from file
 with open('keys_related/valid_api_keys.txt', 'r') as f:
-    api_keys = [line.strip() for line in f]
+    api_keys = [line.strip() for line in f if line.strip()]
 
-# Store expired keys here
-expired_keys = []
+# Charges every call to its key and hands out keys by remaining daily quota
+scheduler = QuotaScheduler(api_keys)
 
-# To keep track of channel_ids. Prevents duplicate.
-channel_ids = []
+# Distinct channel ids of the collected videos. Their details are fetched in a separate stage.
+channel_ids = set()
+channel_ids_lock = threading.Lock()
 
-# Build a service object for interacting with the API.
+# Cache of video_id -> publishedAt, filled from every response that carries a snippet.
+# Lets the full fetch skip out-of-range ids without another call.
+published_dates = {}
+
+# Reuses one client per (API key, thread), built from the static discovery document
+client_pool = ClientPool()
+
+# Video categories are reference data, fetched once per run
+video_categories = None
+categories_lock = threading.Lock()
+
+# Get the service object for interacting with the API.
 def get_authenticated_service(api_key):
-    return build('youtube', 'v3', developerKey=api_key)
+    return client_pool.get(api_key)
+
+# Run func(service, *args) with the key that has the most quota left, moving to the next key on quota errors
+# and retrying rate limits and transient errors with backoff. Other errors are raised.
+def run_with_key(endpoint, func, *args):
+    return scheduler.run(endpoint, lambda api_key: func(get_authenticated_service(api_key), *args))
+
+# Function to fetch every reply of a comment thread through comments().list, 100 per page
+def get_comment_replies(service, parent_id, comment_attrs, channel_id):
+    replies = []
+    page_token = None
+
+    while True:
+        results = scheduler.execute(service.comments().list(
+            part="snippet",
+            parentId=parent_id,
+            maxResults=100,
+            pageToken=page_token,
+            textFormat="plainText",
+        ))
+
+        for reply in results["items"]:
+            replies.append(build_reply_details(reply, comment_attrs, channel_id))
 
-# Function to fetch comments from a video with additional details
-def get_video_comments(service, video_id, channel_id, comment_attrs, comment_limit=None):
+        page_token = results.get("nextPageToken")
+        if not page_token:
+            break
+
+    return replies
+
+# Function to fetch comments from a video with additional details, 100 comment threads per page.
+# With a comment_writer, every page is written as it arrives and an empty list is returned.
+# With a journal, the next page token is recorded after every page so an interrupted
+# pagination continues from where it stopped.
+# With include_replies, replies are added as rows with a parent_id. Threads with more replies than
+# the few returned inline are expanded through comments().list, concurrently when a reply_executor is given.
+# With since, the (published_at, comment_id) of the newest comment of an earlier run, comments are requested
+# newest first and the pagination stops at the first comment that was already collected.
+def get_video_comments(service, video_id, channel_id, comment_attrs, comment_limit=None, journal=None, comment_writer=None,
+                       include_replies=False, reply_executor=None, since=None):
     comments = []
+    page_token = None
+    reached_known = False
+    thread_count = 0  # The comment limit applies to top-level comments
 
-    try:
-        results = service.commentThreads().list(
-            part="snippet,replies",
-            videoId=video_id,
-            textFormat="plainText",
-        ).execute()
+    # Continue an interrupted pagination from the saved page token
+    if journal is not None:
+        if journal.is_done('comment_page', video_id):
+            return comments
 
-        while results and (comment_limit is None or len(comments) < comment_limit):
+        saved = journal.last_entry('comment_page', video_id)
+        page_token = saved.get('token')
+        thread_count = saved.get('count', 0)
+
+    try:
+        while comment_limit is None or thread_count < comment_limit:
+            results = scheduler.execute(service.commentThreads().list(
+                part="snippet,replies",
+                videoId=video_id,
+                maxResults=100,
+                order="time" if since else None,
+                pageToken=page_token,
+                textFormat="plainText",
+            ))
+
+            page = []
+            expand_ids = []
             for item in results["items"]:
-                comment = item["snippet"]["topLevelComment"]
-                comment_dict = {}
-
-                if comment_attrs.get('comment_id', False):
-                    comment_dict['comment_id'] = comment['id']
-                if comment_attrs.get('commenter_name', False):
-                    comment_dict['commenter_name'] = comment['snippet']['authorDisplayName']
-                if comment_attrs.get('commenter_id', False):
-                    if 'authorChannelId' in comment['snippet']:
-                        comment_dict['commenter_id'] = comment['snippet']['authorChannelId']['value']
+                # Everything from here on was collected by the earlier run
+                if since and is_known_comment(item, since):
+                    reached_known = True
+                    break
+
+                page.append(build_comment_details(item, comment_attrs, channel_id, include_replies))
+                thread_count += 1
+
+                if include_replies:
+                    inline_replies = item.get('replies', {}).get('comments', [])
+                    if item['snippet']['totalReplyCount'] > len(inline_replies):
+                        expand_ids.append(item['id'])
                     else:
-                        comment_dict['commenter_id'] = None
-                if comment_attrs.get('comment_display', False):
-                    comment_dict['comment_display'] = comment['snippet']['textDisplay']
-                if comment_attrs.get('comment_original', False):
-                    comment_dict['comment_original'] = comment['snippet']['textOriginal']
-                if comment_attrs.get('comment_likes', False):
-                    comment_dict['comment_likes'] = comment['snippet']['likeCount']
-                if comment_attrs.get('comment_total_replies', False):
-                    comment_dict['comment_total_replies'] = item['snippet']['totalReplyCount']
-                if comment_attrs.get('comment_published_date', False):
-                    comment_dict['comment_published_date'] = comment['snippet']['publishedAt']
-                if comment_attrs.get('comment_update_date', False):
-                    comment_dict['comment_update_date'] = comment['snippet']['updatedAt']
-                if comment_attrs.get('comment_extracted_date', False):
-                    comment_dict['comment_extracted_date'] = datetime.now().isoformat()
-
-                # Add channel_id to the comment dict
-                comment_dict['channel_id'] = channel_id
-                comments.append(comment_dict)
+                        page.extend(build_reply_details(reply, comment_attrs, channel_id) for reply in inline_replies)
 
                 # Break if comment limit is reached
-                if comment_limit is not None and len(comments) >= comment_limit:
+                if comment_limit is not None and thread_count >= comment_limit:
                     break
 
-            # Check if there are more comments and fetch them
-            if "nextPageToken" in results:
-                results = service.commentThreads().list(
-                    part="snippet,replies",
-                    videoId=video_id,
-                    pageToken=results["nextPageToken"],
-                    textFormat="plainText",
-                ).execute()
+            # Expand the threads with many replies. The page is only saved once all of its replies are in.
+            if reply_executor is not None:
+                reply_futures = [reply_executor.submit(run_with_key, 'comments.list', get_comment_replies, parent_id, comment_attrs, channel_id)
+                                 for parent_id in expand_ids]
+                for reply_future in reply_futures:
+                    page.extend(reply_future.result())
             else:
+                for parent_id in expand_ids:
+                    page.extend(get_comment_replies(service, parent_id, comment_attrs, channel_id))
+
+            # Check if there are more comments
+            page_token = results.get("nextPageToken") if not reached_known else None
+
+            if comment_writer is not None:
+                for comment_dict in page:
+                    comment_dict['video_id'] = video_id
+                comment_writer.write_rows(page)
+                if journal is not None and page_token:
+                    journal.record('comment_page', video_id, token=page_token, count=thread_count, channel=channel_id)
+            else:
+                comments.extend(page)
+
+            if not page_token:
                 break
 
+        if journal is not None:
+            journal.mark_done('comment_page', video_id)
+
     except HttpError as e:
-        error_info = json.loads(e.content.decode())
-        if error_info.get('error', {}).get('errors', [{}])[0].get('reason') == 'commentsDisabled':
+        # Error bodies are not always JSON, e.g. the HTML page of a 502
+        if body_reason(e.content) == 'commentsDisabled':
+            metrics.inc('youtube_comments_disabled_total')
+            if journal is not None:
+                journal.mark_done('comment_page', video_id)
             return None
         else:
             raise e  # Raise the error if it's due to any other reason
 
-    return comments[:comment_limit]
+    return comments
+
+# Fetch video categories as a category id -> category name mapping. Only the first call hits the API.
+def get_video_categories(service):
+    global video_categories
+
+    with categories_lock:
+        if video_categories is None:
+            categories = scheduler.execute(service.videoCategories().list(
+                part = 'snippet',
+                regionCode = 'US'
+            ))
+
+            video_categories = {item['id']: item['snippet']['title'] for item in categories['items']}
+
+    return video_categories
 
 # Function to fetch video details
 
 def get_video_details(service, video_id, fetch_attrs, comment_limit, start_date, end_date):
     video_details = {}
 
-    # Fetch video categories
-    video_categories = {}
-    categories = service.videoCategories().list(
-        part = 'snippet',
-        regionCode = 'US'
-    ).execute()
+    # Skip the request if the publish date is already known to be out of range
+    if video_id in published_dates and not in_date_range(published_dates[video_id], start_date, end_date):
+        return None
 
-    for item in categories['items']:
-        video_categories[item['id']] = item['snippet']['title']
+    # Fetch video categories
+    video_categories = get_video_categories(service)
 
     # Fetch other video details if needed
     if any(fetch_attrs.values()):
-        response = service.videos().list(
+        response = scheduler.execute(service.videos().list(
             part='snippet,contentDetails,statistics,topicDetails',
             id=video_id
-        ).execute()
+        ))
 
         # Check if any video details are available
         if 'items' in response:
@@ -122,176 +212,192 @@ def get_video_details(service, video_id, fetch_attrs, comment_limit, start_date,
                 item = response['items'][0]
             except:
                 print(video_id + ' is not available')
+                metrics.inc('youtube_videos_unavailable_total')
                 return None
-            if end_date is None:
-                end_date = datetime.now().isoformat() + 'Z'
-            else:
-                end_date += ' 23:59:59'
 
-            start_date = datetime.strptime(start_date, '%Y-%m-%d %H:%M:%S') if isinstance(start_date, str) else start_date
+            published_dates[video_id] = item['snippet']['publishedAt']
+            if not in_date_range(item['snippet']['publishedAt'], start_date, end_date):
+                return None
 
+            video_details = build_video_details(item, fetch_attrs, video_categories)
 
-            end_date = datetime.strptime(end_date, '%Y-%m-%dT%H:%M:%S.%fZ') if isinstance(end_date, str) else end_date
+    # Fetch comments if needed
+    if fetch_attrs.get('comments', False) and video_details:
+        video_details['comments'] = get_video_comments(service, video_id, comment_limit, start_date, end_date)
 
-            published_date = item['snippet']['publishedAt']
-            published_date = datetime.strptime(published_date, "%Y-%m-%dT%H:%M:%SZ")
+    return video_details
 
-            if start_date and published_date < start_date:
-                print('published_date:' , published_date, 'start_date:' , start_date)
-                return None
+# Function to fetch video details for up to 50 video ids with a single videos().list call.
+# Returns a dict of video_id -> video details (None if the video is not available or out of range)
+def get_video_details_batch(service, video_ids, fetch_attrs, start_date, end_date):
+    video_details = {}
 
-            if end_date and published_date > end_date:
-                print('published_date:' , published_date, 'end_date:' , end_date)
-                return None
+    # Skip ids whose publish date is already known to be out of range
+    fetch_ids = []
+    for video_id in video_ids:
+        if video_id in published_dates and not in_date_range(published_dates[video_id], start_date, end_date):
+            video_details[video_id] = None
+        else:
+            fetch_ids.append(video_id)
 
-            if fetch_attrs.get('title', False):
-                video_details['title'] = item['snippet']['title']
+    if not fetch_ids:
+        return video_details
 
-            if fetch_attrs.get('description', False):
-                video_details['description'] = item['snippet']['description']
+    video_categories = get_video_categories(service)
 
-            if fetch_attrs.get('published_date', False):
-                video_details['published_date'] = item['snippet']['publishedAt']
+    response = scheduler.execute(service.videos().list(
+        part='snippet,contentDetails,statistics,topicDetails',
+        id=','.join(fetch_ids)
+    ))
 
-            if fetch_attrs.get('channel_id', False):
-                video_details['channel_id'] = item['snippet']['channelId']
+    # Missing, private and deleted videos are simply absent from the response
+    items = {item['id']: item for item in response.get('items', [])}
 
-            if fetch_attrs.get('category', False):
-                # Convert category id to category name
-                category_id = item['snippet']['categoryId']
-                video_details['category'] = video_categories.get(category_id, 'Unknown')
+    for video_id in fetch_ids:
+        item = items.get(video_id)
+        if item is None:
+            print(video_id + ' is not available')
+            metrics.inc('youtube_videos_unavailable_total')
+            video_details[video_id] = None
+            continue
 
-            if fetch_attrs.get('duration', False):
-                video_details['duration'] = isodate.parse_duration(item['contentDetails']['duration']).total_seconds()
+        published_dates[video_id] = item['snippet']['publishedAt']
+        if not in_date_range(item['snippet']['publishedAt'], start_date, end_date):
+            video_details[video_id] = None
+        else:
+            video_details[video_id] = build_video_details(item, fetch_attrs, video_categories)
 
-            if fetch_attrs.get('total_views', False):
-                video_details['total_views'] = item['statistics'].get('viewCount', '0')
+    return video_details
 
-            if fetch_attrs.get('total_likes', False):
-                video_details['total_likes'] = item['statistics'].get('likeCount', '0')
+# Function to fetch the raw channel items of up to 50 channel ids with a single channels().list call
+def get_channel_items_batch(service, channel_ids):
+    response = scheduler.execute(service.channels().list(
+        part="snippet,statistics,topicDetails",
+        id=','.join(channel_ids)
+    ))
+
+    return {item['id']: item for item in response.get('items', [])}
+
+# Function to collect channel details for a set of channel ids, 50 per request.
+# Channels found in the cache are not requested again. Rows go to the channel writer.
+# Chunks that fail after the retries are recorded in failed, if given.
+def collect_channel_details(channel_ids, channel_writer, journal=None, cache=None, failed=None):
+    items = {}
+    fetch_ids = []
+
+    for channel_id in channel_ids:
+        item, fetched_at = cache.get(channel_id) if cache is not None else (None, None)
+        if item is None:
+            fetch_ids.append(channel_id)
+        else:
+            items[channel_id] = (item, fetched_at)
 
-            if fetch_attrs.get('total_dislikes', False):
-                video_details['total_dislikes'] = item['statistics'].get('dislikeCount', '0')
+    print(f"Channels: {len(items)} from cache, {len(fetch_ids)} to fetch.")
 
-            if fetch_attrs.get('total_comments', False):
-                video_details['total_comments'] = item['statistics'].get('commentCount', '0')
+    with ThreadPoolExecutor() as executor:
+        futures = {executor.submit(run_with_key, 'channels.list', get_channel_items_batch, channel_chunk): channel_chunk
+                   for channel_chunk in chunk_list(fetch_ids, 50)}
 
-            if fetch_attrs.get('video_extracted_date', False):
-                video_details['video_extracted_date'] = datetime.now().isoformat()
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Processing channel ids..."):
+            try:
+                for channel_id, item in future.result().items():
+                    if cache is not None:
+                        cache.put(channel_id, item)
+                    items[channel_id] = (item, None)
+            except QuotaExhaustedError as exc:
+                print(exc)
+            except Exception as e:
+                print(f"An error occurred while fetching channel details: {e}")
+                if failed is not None:
+                    for channel_id in futures[future]:
+                        failed.record('channel', channel_id, e)
+
+    for channel_id in channel_ids:
+        if channel_id not in items:
+            print(f"Channel {channel_id} is not available")
+            continue
 
-            if fetch_attrs.get('thumbnail', False):
-                video_details['thumbnail'] = item['snippet']['thumbnails']['high']['url']
+        item, fetched_at = items[channel_id]
+        channel_details = build_channel_details(item, channel_id, channel_attrs)
 
-            if fetch_attrs.get('topic_categories', False):
-                topic_categories = item.get('topicDetails', {}).get('topicCategories', [])
-                video_details['topic_categories'] = ', '.join(topic_categories)
+        # Cached channels keep the date they were actually extracted
+        if fetched_at is not None and 'channel_extracted_date' in channel_details:
+            channel_details['channel_extracted_date'] = fetched_at
 
-    # Fetch comments if needed
-    if fetch_attrs.get('comments', False) and video_details:
-        video_details['comments'] = get_video_comments(service, video_id, comment_limit, start_date, end_date)
+        channel_writer.write(channel_details)
+        if journal is not None:
+            journal.mark_done('channel', channel_id)
 
-    return video_details
+# Function to fetch only the statistics of up to 50 video or channel ids with a single list call
+def get_statistics_batch(service, kind, ids):
+    resource = service.videos() if kind == 'video' else service.channels()
+    response = scheduler.execute(resource.list(
+        part='statistics',
+        id=','.join(ids)
+    ))
 
-# Function to fetch channel details
-def get_channel_details(service, channel_id):
-    try:
-        response = service.channels().list(
-            part="snippet,statistics,topicDetails",
-            id=channel_id
-        ).execute()
+    return response.get('items', [])
 
-        if 'items' in response:
-            channel = response['items'][0]
-            channel_details = {}
-
-            if channel_attrs.get('channel_id', False):
-                channel_details['channel_id'] = channel_id
-            if channel_attrs.get('channel_title', False):
-                channel_details['channel_title'] = channel['snippet']['title']
-            if channel_attrs.get('description', False):
-                channel_details['description'] = channel['snippet']['description']
-            if channel_attrs.get('joined_date', False):
-                channel_details['joined_date'] = channel['snippet']['publishedAt']
-            if channel_attrs.get('location', False):
-                channel_details['location'] = channel['snippet'].get('country', 'Unknown')
-            if channel_attrs.get('total_subscribers', False):
-                channel_details['total_subscribers'] = channel['statistics']['subscriberCount']
-            #if channel_attrs.get('total_views', False):
-                #channel_details['total_views'] = channel['statistics']['viewCount']
-            if channel_attrs.get('total_videos', False):
-                channel_details['total_videos'] = channel['statistics']['videoCount']
-            if channel_attrs.get('extracted_date', False):
-                channel_details['extracted_date'] = datetime.now().isoformat()
-            if channel_attrs.get('thumbnail', False):
-                channel_details['thumbnail'] = channel['snippet']['thumbnails']['high']['url']
-            if channel_attrs.get('language', False):
-                channel_details['language'] = channel.get('snippet', {}).get('defaultLanguage', 'Unknown')
-            if channel_attrs.get('channel_extracted_date', False):
-                channel_details['channel_extracted_date'] = datetime.now().isoformat()
-            if channel_details.get('topic_categories', False):
-                topic_categories = channel.get('topicDetails', {}).get('topicCategories', [])
-                channel_details['topic_categories'] = ', '.join(topic_categories)
-
-
-            return channel_details
-        else:
-            return None
+# Function to append a statistics snapshot of video or channel ids to a long-format time-series file.
+# Every row is (snapshot_time, kind, id, metric, value) and all rows of a run share the same snapshot_time.
+def collect_statistics_snapshot(ids, kind, stats_writer):
+    snapshot_time = datetime.now().isoformat()
+    endpoint = 'videos.list' if kind == 'video' else 'channels.list'
+    found = 0
 
-    except HttpError as e:
-        print(f"An HTTP error occurred while fetching channel details for channel {channel_id}.")
-        print(f"Error details: {e.content.decode()}")
-        return None
+    with ThreadPoolExecutor() as executor:
+        futures = [executor.submit(run_with_key, endpoint, get_statistics_batch, kind, id_chunk)
+                   for id_chunk in chunk_list(list(dict.fromkeys(ids)), 50)]
 
+        for future in tqdm(as_completed(futures), total=len(futures), desc=f"Processing {kind} statistics..."):
+            try:
+                items = future.result()
+            except QuotaExhaustedError as exc:
+                print(exc)
+                continue
+            except HttpError as e:
+                print("An HTTP error occurred while fetching statistics.")
+                print(f"Error details: {e.content.decode()}")
+                continue
 
+            for item in items:
+                stats_writer.write_rows(build_statistics_rows(item, kind, snapshot_time))
+            found += len(items)
 
-# Function to handle video and comment details fetching for each video id
-def get_details_from_video_ids(video_id, video_attrs, comment_attrs, additional_attrs,  comment_limit, start_time=None, end_time=None):
-    video_details = None
-    comments_details = None
-    channel_details = None
+    print(f"Statistics snapshot {snapshot_time}: {found} {kind}s.")
 
-    for api_key in api_keys:
-        # Skip if the key is expired
-        if api_key in expired_keys:
-            continue
-        try:
-            service = get_authenticated_service(api_key)
-            video_details = get_video_details(service, video_id, video_attrs, comment_limit, start_time, end_time)
 
-            if video_details is None:
-                break
+# Function to handle video details fetching for each video id. Comments are collected in a separate stage.
+# Errors that are left after the retries are raised, so the video is reported as failed instead of dropped.
+def get_details_from_video_ids(video_id, video_attrs, additional_attrs, comment_limit, start_time=None, end_time=None):
+    video_details = run_with_key('videos.list', get_video_details, video_id, video_attrs, comment_limit, start_time, end_time)
 
-            channel_id = video_details['channel_id']
-            if channel_id not in channel_ids:
-                channel_details = get_channel_details(service, channel_id)
-                channel_ids.append(channel_id)
+    # Include additional attributes in the returned data
+    if video_details is not None:
+        video_details.update(additional_attrs)
 
-            # Fetch comments details if not ignored
-            if not ignore_comments:
-                channel_id = video_details.get('channel_id')
-                comments_details = get_video_comments(service, video_id, channel_id, comment_attrs, comment_limit)
+    return video_details
 
-            # Include additional attributes in the returned data
-            video_details.update(additional_attrs)
 
-            break
+# Function to handle video details fetching for a chunk of up to 50 video ids.
+# Returns the video details (None if not available) per video id, in input order
+def get_details_from_video_id_batch(video_ids, video_attrs, additional_attrs, start_time=None, end_time=None):
+    batch_details = run_with_key('videos.list', get_video_details_batch, video_ids, video_attrs, start_time, end_time)
 
-        except HttpError as e:
-            print(f"An HTTP error {e.resp.status} occurred with key {api_key}.")
-            error_content = e.content.decode()
-            print(f"Error details: {error_content}")
+    results = []
+    for idx, video_id in enumerate(video_ids):
+        video_details = batch_details[video_id]
 
-            # Check if the error is quota related
-            if "quota" in error_content.lower():
-                expired_keys.append(api_key)
-            else:
-                # If it's not quota related, break out of the loop
-                break
+        # Include additional attributes in the returned data
+        if video_details is not None:
+            video_details.update(additional_attrs[idx])
+
+        results.append(video_details)
 
-    return video_details, comments_details, channel_details
+    return results
 
 
-# Function to fetch video ids from a channel
+# Function to fetch video ids from a channel. Errors are raised, so an incomplete listing is never saved.
 def get_video_ids_from_channel(service, channel_id, start_date=None, end_date=None):
     video_ids = []
 
@@ -305,67 +411,138 @@ def get_video_ids_from_channel(service, channel_id, start_date=None, end_date=No
     else:
         end_date += 'T23:59:59.999Z'
 
-    try:
-        # Use the search() function to get videos from the channel
-        results = service.search().list(
-            channelId=channel_id,
-            part="id,snippet",
-            order="date",
-            publishedAfter=start_date,
-            publishedBefore=end_date,
-            maxResults=50  # Maximum allowed results per API call
-        ).execute()
-
-        # Loop over the results and add video ids to the list
-        while results:
-            for item in results["items"]:
-                if item['id']['kind'] == "youtube#video":
-                    video_ids.append(item['id']['videoId'])
-
-            # Check if there are more videos and fetch them
-            if "nextPageToken" in results:
-                results = service.search().list(
-                    channelId=channel_id,
-                    part="id,snippet",
-                    order="date",
-                    publishedAfter=start_date,
-                    publishedBefore=end_date,
-                    maxResults=50,
-                    pageToken=results["nextPageToken"]
-                ).execute()
-            else:
-                break
+    # Use the search() function to get videos from the channel
+    results = scheduler.execute(service.search().list(
+        channelId=channel_id,
+        part="id,snippet",
+        order="date",
+        publishedAfter=start_date,
+        publishedBefore=end_date,
+        maxResults=50  # Maximum allowed results per API call
+    ))
+
+    # Loop over the results and add video ids to the list
+    while results:
+        for item in results["items"]:
+            if item['id']['kind'] == "youtube#video":
+                video_ids.append(item['id']['videoId'])
+                published_dates[item['id']['videoId']] = item['snippet']['publishedAt']
+
+        # Check if there are more videos and fetch them
+        if "nextPageToken" in results:
+            results = scheduler.execute(service.search().list(
+                channelId=channel_id,
+                part="id,snippet",
+                order="date",
+                publishedAfter=start_date,
+                publishedBefore=end_date,
+                maxResults=50,
+                pageToken=results["nextPageToken"]
+            ))
+        else:
+            break
 
-    except HttpError as e:
-        print(f"An HTTP error {e.resp.status} occurred while fetching videos from channel {channel_id}.")
-        print(f"Error details: {e.content.decode()}")
+    return video_ids
+
+# Function to resolve the uploads playlist of up to 50 channels with one channels().list call
+def get_uploads_playlist_ids(service, channel_ids):
+    response = scheduler.execute(service.channels().list(
+        part="contentDetails",
+        id=','.join(channel_ids)
+    ))
+
+    return {item['id']: item['contentDetails']['relatedPlaylists']['uploads'] for item in response.get('items', [])}
+
+# Function to fetch video ids from an uploads playlist (1 quota unit per page of 50).
+# Publish dates are filtered on the client side.
+def get_video_ids_from_playlist(service, playlist_id, start_date=None, end_date=None):
+    video_ids = []
+    page_token = None
+
+    while True:
+        results = scheduler.execute(service.playlistItems().list(
+            part="contentDetails",
+            playlistId=playlist_id,
+            maxResults=50,
+            pageToken=page_token
+        ))
+
+        older_count = 0
+        for item in results["items"]:
+            video_id = item['contentDetails']['videoId']
+            published_at = item['contentDetails'].get('videoPublishedAt')
+
+            # Private and deleted videos have no publish date
+            if published_at is None:
+                continue
+
+            published_dates[video_id] = published_at
+            if in_date_range(published_at, start_date, end_date):
+                video_ids.append(video_id)
+            elif not in_date_range(published_at, start_date, None):
+                older_count += 1
+
+        page_token = results.get("nextPageToken")
+
+        # Uploads are listed newest first, so stop once a whole page is older than the start date
+        if not page_token or (results["items"] and older_count == len(results["items"])):
+            break
 
     return video_ids
 
-def is_in_date_range(service, video_id, start_date, end_date):
-    response = service.videos().list(
-        part='snippet',
-        id=video_id
-    ).execute()
-    # Check if any video details are available
-    if 'items' in response:
-        # Video is removed or not available.
-        if not response['items']:
-            return False
+# Function to fetch the video ids of many channels through their uploads playlists, channels run concurrently
+# Channels whose listing fails after the retries are recorded in failed, if given.
+def get_video_ids_from_channel_uploads(channel_ids, start_date=None, end_date=None, journal=None, failed=None):
+    video_ids = []
+
+    if journal is not None:
+        for channel_id in channel_ids:
+            if journal.is_done('channel_uploads', channel_id):
+                video_ids.extend(journal.collected_items('channel_uploads', channel_id))
+        channel_ids = [channel_id for channel_id in channel_ids if not journal.is_done('channel_uploads', channel_id)]
+
+    # Resolve the uploads playlists, 50 channels per request
+    playlist_ids = {}
+    for channel_chunk in chunk_list(channel_ids, 50):
+        try:
+            playlist_ids.update(run_with_key('channels.list', get_uploads_playlist_ids, channel_chunk))
+        except QuotaExhaustedError as exc:
+            print(exc)
+            break
+        except Exception as e:
+            print(f"An error occurred while resolving uploads playlists: {e}")
+            if failed is not None:
+                for channel_id in channel_chunk:
+                    failed.record('channel_uploads', channel_id, e)
+
+    for channel_id in channel_ids:
+        if channel_id not in playlist_ids:
+            print(f"Channel {channel_id} is not available")
 
-        item = response['items'][0]
-        published_date = item['snippet']['publishedAt']
-        published_date = datetime.strptime(published_date, "%Y-%m-%dT%H:%M:%SZ")
+    def fetch_uploads(channel_id):
+        try:
+            channel_video_ids = run_with_key('playlistItems.list', get_video_ids_from_playlist, playlist_ids[channel_id], start_date, end_date)
+        except QuotaExhaustedError:
+            raise
+        except Exception as e:
+            print(f"An error occurred while fetching videos from channel {channel_id}: {e}")
+            if failed is not None:
+                failed.record('channel_uploads', channel_id, e)
+            return []
 
-        start_date = datetime.strptime(start_date, '%Y-%m-%d')
-        end_date = datetime.strptime(end_date, '%Y-%m-%d')
+        if journal is not None:
+            journal.record('channel_uploads', channel_id, items=channel_video_ids, done=True)
+        return channel_video_ids
 
-        if start_date and published_date < start_date:
-            return False
-        if end_date and published_date > end_date:
-            return False
+    with ThreadPoolExecutor() as executor:
+        futures = [executor.submit(fetch_uploads, channel_id) for channel_id in channel_ids if channel_id in playlist_ids]
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Listing channel uploads..."):
+            try:
+                video_ids.extend(future.result())
+            except QuotaExhaustedError as exc:
+                print(exc)
 
-    return True
+    return video_ids
 
 
 # Translate attributes
@@ -388,113 +565,549 @@ def translate(file_name):
             translate_en(translate_filename, doc="title", attribute='comment_display')
 """
 
+# Use the API keys of a keys file instead of keys_related/valid_api_keys.txt, e.g. the subset of one worker host.
+# Their usage is kept in a ledger next to the keys file.
+def use_api_keys(api_keys_path):
+    global api_keys, scheduler
 
-def main(file_name, input_folder, video_attrs, comment_attrs, translate_attrs, keep_old_attr=False, comment_limit=None, ignore_comments=False, read_channel=False, start_date=None, end_date=None):
-    try:
-        # Try to read the CSV file
-        if not os.path.exists(input_folder):
-            os.makedirs(input_folder)
+    with open(api_keys_path, 'r') as f:
+        api_keys = [line.strip() for line in f if line.strip()]
+    scheduler = QuotaScheduler(api_keys, ledger_path=os.path.splitext(api_keys_path)[0] + '_ledger.json')
+    print(f"Using {len(api_keys)} API keys from {api_keys_path}.")
+
+# Coordinator: queue the video ids (or channel ids) of an input file for the workers.
+# With keep_old_attr, the other columns of every video travel with it. Returns the number of new tasks.
+def enqueue_input(queue, df, read_channel=False, keep_old_attr=False):
+    if read_channel:
+        return queue.enqueue('channel', df['channel_id'].dropna().astype(str).tolist())
+
+    df = df.dropna(subset=['video_id'])
+    if keep_old_attr:
+        records = df.drop(columns=['video_id']).astype(object).where(df.drop(columns=['video_id']).notna(), None).to_dict('records')
+        return queue.enqueue('video', list(zip(df['video_id'].astype(str), records)))
+    return queue.enqueue('video', df['video_id'].astype(str).tolist())
+
+# Merge the sharded outputs of every worker that took part in the crawl into the regular output files
+def merge_worker_outputs(queue, file_name, output_format='csv', partition_by_month=False):
+    output_folder = "output_data/"
+    worker_ids = sorted(set(queue.workers('video')) | set(queue.workers('channel')))
+    print(f"Merging the outputs of {len(worker_ids)} workers.")
+
+    for output, unique_key, partition_column in (('video', 'video_id', 'published_date'), ('channels', 'channel_id', None),
+                                                 ('comment', 'comment_id', 'comment_published_date')):
+        paths = [output_path(f'{output_folder}{file_name}_{worker_id}_{output}', output_format) for worker_id in worker_ids]
+        paths = [path for path in paths if os.path.exists(path)]
+        if not paths:
+            continue
+
+        rows = merge_outputs(paths, output_folder + file_name + '_' + output, output_format, unique_key, partition_column, partition_by_month)
+        print(f"{file_name}_{output}: {rows} rows from {len(paths)} shards.")
+
+        if output == 'comment':
+            combined_extension = '.parquet' if output_format == 'parquet' else '.csv'
+            combine_comments(output_path(output_folder + file_name + '_comment', output_format),
+                             output_folder + file_name + '_comment_combined' + combined_extension)
+
+
+def main(file_name, input_folder, video_attrs, comment_attrs, translate_attrs, keep_old_attr=False, comment_limit=None, ignore_comments=False, read_channel=False, start_date=None, end_date=None, batch_videos=False, batch_size=50, resume=False,
+         engine='threads', max_in_flight=1000, per_key_in_flight=100, requests_per_second=None, channel_source='uploads',
+         channel_cache_days=7, comment_workers=16, include_replies=False, incremental_comments=False, snapshot_statistics=False,
+         translate_pipeline=False, translation_workers=8, translation_queue_size=1000, output_format='csv', partition_by_month=False,
+         metrics_port=None, metrics_dump_interval=60, retry_failed=False, queue_mode=None, queue_path='output_data/work_queue.db',
+         worker_id=None, worker_batch_size=1000, lease_seconds=600, api_keys_path=None):
+    output_folder = "output_data/"
+
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder)
+
+    # Distributed mode, the workers and the merge step take their work from the queue instead of the input file
+    queue = None
+    if queue_mode is not None:
+        queue = WorkQueue(queue_path, lease_seconds)
 
-        df = pd.read_csv(input_folder + file_name + ".csv")
-    except Exception as e:
-        print(f"Could not read CSV file: {e}")
-        print("Attempting to read Excel file...")
+    if queue_mode == 'merge':
+        merge_worker_outputs(queue, file_name, output_format, partition_by_month)
+        queue.close()
+        return
 
+    df = None
+    if queue_mode != 'worker':
         try:
-            # Try to read the Excel file
-            df = pd.read_excel(input_folder + file_name + ".xlsx")
-        except Exception as e:
-            print(f"Could not read Excel file: {e}")
-            return  # If we couldn't read either file, end the execution here
+            # Try to read the CSV file
+            if not os.path.exists(input_folder):
+                os.makedirs(input_folder)
 
-    api_cycle = cycle(api_keys)  # Cycle through the API keys
-    if read_channel:
-        # Read channel ids and fetch video ids
-        channel_ids = df['channel_id'].tolist()
-        video_ids = []
-        for channel_id in channel_ids:
-            api_key = next(api_cycle)  # Get the next API key
-            while api_key in expired_keys:
-                api_key = next(api_cycle)  # Get the next API key if the current one is expired
-            service = get_authenticated_service(api_key)
-            video_ids.extend(get_video_ids_from_channel(service, channel_id, start_date, end_date))
-    else:
-        raw_video_ids = df['video_id'].tolist()
-        video_ids = []
-        additional_attrs = df.drop(columns=['video_id']) if keep_old_attr else None
+            df = pd.read_csv(input_folder + file_name + ".csv")
+        except Exception as e:
+            print(f"Could not read CSV file: {e}")
+            print("Attempting to read Excel file...")
 
-        if start_date == None and end_date == None:
-            video_ids = raw_video_ids
+            try:
+                # Try to read the Excel file
+                df = pd.read_excel(input_folder + file_name + ".xlsx")
+            except Exception as e:
+                print(f"Could not read Excel file: {e}")
+                return  # If we couldn't read either file, end the execution here
+
+    if queue_mode == 'coordinator':
+        kind = 'channel' if read_channel else 'video'
+        added = enqueue_input(queue, df, read_channel, keep_old_attr)
+        print(f"Queued {added} new {kind} ids in {queue_path}: {queue.stats(kind)}")
+        queue.close()
+        return
+
+    if queue_mode == 'worker':
+        worker_id = worker_id or default_worker_id()
+        # Every worker writes its own shard of the outputs and continues it when restarted with the same id
+        file_name = f'{file_name}_{worker_id}'
+        resume = True
+        retry_failed = False
+        print(f"Worker {worker_id} taking work from {queue_path}.")
+
+    if api_keys_path is not None:
+        use_api_keys(api_keys_path)
+
+    # Metrics of the run: Prometheus text on metrics_port, and a JSON snapshot every metrics_dump_interval seconds
+    metrics_path = output_folder + file_name + '_metrics.json'
+    if metrics_port:
+        metrics.start_http_server(metrics_port)
+    if metrics_dump_interval:
+        metrics.start_json_dump(metrics_path, metrics_dump_interval)
+
+    # Statistics only: append the current counts of the listed ids to the time-series file and stop
+    if snapshot_statistics and df is not None:
+        stats_writer = open_row_writer(output_folder + file_name + '_stats_timeseries', output_format, chunk_size=10000, append=True)
+        if read_channel:
+            collect_statistics_snapshot(df['channel_id'].dropna().tolist(), 'channel', stats_writer)
+        else:
+            collect_statistics_snapshot(df['video_id'].dropna().tolist(), 'video', stats_writer)
+        stats_writer.close()
+        scheduler.save()
+        return
+
+    # Items that still failed after the retries are recorded here. A retry pass (retry_failed) reads the
+    # list of the earlier run and resumes it with only those items.
+    failed_path = output_folder + file_name + '_failed.jsonl'
+    failed_videos = set()
+    if retry_failed:
+        previous_failed_path = output_folder + file_name + '_failed_previous.jsonl'
+        if os.path.exists(failed_path):
+            os.replace(failed_path, previous_failed_path)
+        failed_entries = read_failed_items(previous_failed_path)
+        failed_videos = {entry['id'] for entry in failed_entries if entry['kind'] == 'video'}
+        failed_channels = {entry['id'] for entry in failed_entries if entry['kind'] in ('channel_uploads', 'channel_search')}
+        print(f"Retrying {len(failed_videos)} videos and {len(failed_channels)} channel listings that failed.")
+
+        if read_channel:
+            df = df[df['channel_id'].isin(failed_channels)]
         else:
-            for video_id in tqdm(raw_video_ids, total=len(raw_video_ids), desc="Checking range..."):
-                api_key = next(api_cycle)  # Get the next API key
-                while api_key in expired_keys:
-                    api_key = next(api_cycle)  # Get the next API key if the current one is expired
-                service = get_authenticated_service(api_key)
-                if is_in_date_range(service, video_id, start_date, end_date):
-                    video_ids.append(video_id)
+            df = df[df['video_id'].isin(failed_videos)].reset_index(drop=True)
 
-    pbar = tqdm(total=len(video_ids), desc="Processing video ids...")
+        # A retry pass appends to the outputs of the earlier run
+        resume = True
+    elif not resume and os.path.exists(failed_path):
+        os.remove(failed_path)
+    failed = FailedItems(failed_path)
 
-    video_df = pd.DataFrame()
-    comments_df = pd.DataFrame()
-    channel_df = pd.DataFrame()
+    # Progress journal. With resume, finished work recorded by an earlier run is skipped.
+    journal = ProgressJournal(output_folder + file_name + '_journal.jsonl', resume=resume)
 
-    with ThreadPoolExecutor() as executor:
-        if keep_old_attr:
-            future_to_video_id = {
-                executor.submit(get_details_from_video_ids, video_id, video_attrs, comment_attrs, additional_attrs.iloc[idx].to_dict(), comment_limit, start_date, end_date): idx
-                for idx, video_id in enumerate(video_ids)
-            }
-        else:
-            future_to_video_id = {
-                executor.submit(get_details_from_video_ids, video_id, video_attrs, comment_attrs, {}, comment_limit, start_date, end_date): idx
-                for idx, video_id in enumerate(video_ids)
-            }
+    # Video ids of channels, listed from their uploads playlists or with search
+    def list_channel_videos(input_channel_ids):
+        if channel_source == 'uploads':
+            return get_video_ids_from_channel_uploads(input_channel_ids, start_date, end_date, journal, failed)
+
+        channel_video_ids = []
+        for channel_id in input_channel_ids:
+            if journal.is_done('channel_search', channel_id):
+                channel_video_ids.extend(journal.collected_items('channel_search', channel_id))
+                continue
 
-        for future in as_completed(future_to_video_id):
-            idx = future_to_video_id[future]
             try:
-                video_data, comments_data, channel_data = future.result()
-
-                # Update video data
-                if video_data:
-                    video_data['video_id'] = video_ids[idx]  # Add video id to video_data
-                    video_df = pd.concat([video_df, pd.DataFrame(video_data, index=[0])], ignore_index=True)
-                # Update comments data
-                if comments_data and not ignore_comments:
-                    for comment_data in comments_data:
-                        comment_data['video_id'] = video_ids[idx]  # Add video id to each comment dict
-                    comments_df = pd.concat([comments_df, pd.DataFrame(comments_data)], ignore_index=True)
-
-                if channel_data:
-                    channel_df = pd.concat([channel_df, pd.DataFrame(channel_data, index=[0])], ignore_index=True)
-
-            except Exception as exc:
-                tb_str = traceback.format_exception(etype=type(exc), value=exc, tb=exc.__traceback__)
-                print('%r generated an exception: %s' % (video_ids[idx], "".join(tb_str)))
-            pbar.update()
-
-    # Save the video data to a CSV file
-    output_folder = "output_data/"
+                listed = run_with_key('search.list', get_video_ids_from_channel, channel_id, start_date, end_date)
+            except QuotaExhaustedError as exc:
+                print(exc)
+                break
+            except Exception as e:
+                print(f"An error occurred while fetching videos from channel {channel_id}: {e}")
+                failed.record('channel_search', channel_id, e)
+                continue
+            journal.record('channel_search', channel_id, items=listed, done=True)
+            channel_video_ids.extend(listed)
+        return channel_video_ids
+
+    if queue is not None:
+        # Workers lease their video or channel ids from the queue batch by batch
+        video_ids = []
+    elif read_channel:
+        # Read channel ids and list their videos
+        video_ids = list_channel_videos(df['channel_id'].tolist())
+    else:
+        # Date filtering happens inside the main fetch, so every video is only requested once
+        video_ids = df['video_id'].tolist()
 
-    if not os.path.exists(output_folder):
-        os.makedirs(output_folder)
+    # Videos of a channel input that failed in the earlier run, their channels were already listed
+    if retry_failed and read_channel:
+        video_ids.extend(sorted(failed_videos - set(video_ids)))
 
-    video_df.to_csv(output_folder + file_name+'_video.csv', index=False)
+    # Other input columns of every video, added to its row with keep_old_attr
+    if keep_old_attr and not read_channel and queue is None:
+        row_attrs = df.drop(columns=['video_id']).to_dict('records')
+    else:
+        row_attrs = [{} for _ in video_ids]
+
+    # Skip videos finished by an earlier run, channels that were already collected are not fetched again
+    pending_idxs = [idx for idx, video_id in enumerate(video_ids) if not journal.is_done('video', video_id)]
+    if resume:
+        print(f"Resuming: {len(video_ids) - len(pending_idxs)} of {len(video_ids)} video ids are already done.")
+
+    pbar = tqdm(total=len(pending_idxs), desc="Processing video ids...")
+
+    # Rows are buffered and appended to the output files in chunks as they arrive.
+    # The journal flushes them before it records which videos are done.
+    video_writer = open_row_writer(output_folder + file_name + '_video', output_format, 'published_date', partition_by_month,
+                                   append=resume, journal=journal)
+    channel_writer = open_row_writer(output_folder + file_name + '_channels', output_format, unique_key='channel_id', append=resume, journal=journal)
+    # Incremental comments keep the earlier comment file and only append the comments added since
+    latest_comments = {}
+    if incremental_comments and not ignore_comments:
+        latest_comments = read_latest_comments(output_path(output_folder + file_name + '_comment', output_format))
+        print(f"Incremental comments: {len(latest_comments)} videos have comments from an earlier run.")
+
+    comment_writer = open_row_writer(output_folder + file_name + '_comment', output_format, 'comment_published_date', partition_by_month,
+                                     append=resume or incremental_comments, unique_key='comment_id' if incremental_comments else None,
+                                     journal=journal) if not ignore_comments else None
+
+    # Translate the translate_attrs fields while collecting, instead of re-reading the finished files
+    video_pipeline = None
+    comment_pipeline = None
+    if translate_pipeline and translate_attrs['translate']:
+        from translate import TranslationPipeline, TranslatingWriter
+
+        # Rows of the asyncio engine are saved on the event loop thread, where a full pipeline queue would
+        # block every request in flight
+        if engine == 'asyncio':
+            print("Rows are not translated in the pipeline with the asyncio engine, use translate.py afterwards.")
+        else:
+            video_fields = [field for field in ('title', 'description') if translate_attrs[field]]
+            if video_fields:
+                video_pipeline = TranslationPipeline(video_fields, translation_workers, translation_queue_size)
+
+            if translate_attrs['comment'] and comment_writer is not None:
+                comment_pipeline = TranslationPipeline(['comment_display'], translation_workers, translation_queue_size)
+                comment_writer = TranslatingWriter(comment_pipeline, comment_writer)
+
+    quota_exhausted = False
+    # Videos that failed in this run, by id
+    failed_errors = {}
+
+    def report_error(idxs, exc):
+        nonlocal quota_exhausted
+
+        if isinstance(exc, QuotaExhaustedError):
+            # Not marked as done, a resumed run picks these ids up again
+            if not quota_exhausted:
+                print(f"{exc} Run again with resume=True once the quota resets.")
+            quota_exhausted = True
+        else:
+            tb_str = traceback.format_exception(type(exc), exc, exc.__traceback__)
+            print('%r generated an exception: %s' % ([video_ids[idx] for idx in idxs], "".join(tb_str)))
+            for idx in idxs:
+                failed.record('video', video_ids[idx], exc)
+                failed_errors[video_ids[idx]] = exc
+
+    # Comment stage of the thread engine. Every collected video gets its own comment job so the
+    # pagination of many videos runs concurrently, while the pages of one video stay in order.
+    # Comment rows are streamed to the comment writer by the jobs.
+    comment_executor = None
+    reply_executor = None
+    if engine != 'asyncio' and not ignore_comments:
+        comment_executor = ThreadPoolExecutor(max_workers=comment_workers)
+        reply_executor = ThreadPoolExecutor(max_workers=comment_workers) if include_replies else None
+        comment_pbar = tqdm(desc="Processing comments...")
+
+    # Videos whose comments failed in this run, by id
+    comment_errors = {}
+
+    # Unfinished comment pages stay in the journal, so a resumed run or a retry pass continues them
+    def report_comment_error(video_id, exc):
+        report_error([], exc)
+        if not isinstance(exc, QuotaExhaustedError):
+            failed.record('comment', video_id, exc)
+            comment_errors[video_id] = exc
+
+    def comments_done(future, video_id):
+        try:
+            future.result()
+        except Exception as exc:
+            report_comment_error(video_id, exc)
+        comment_pbar.update()
+
+    # (video id, channel id) of the given videos that are collected but whose comments are not finished
+    def unfinished_comments(ids):
+        if ignore_comments:
+            return []
+        return [(video_id, journal.last_entry('comment_page', video_id).get('channel')) for video_id in ids
+                if journal.last_entry('comment_page', video_id) and journal.is_done('video', video_id)]
+
+    # Channel of every video a worker collected, its task is only finished once the channel row is saved
+    video_channels = {}
+
+    # Comment jobs by video id, a worker waits for the jobs of a batch before it settles the batch's tasks
+    comment_jobs = {}
+
+    def queue_comments(video_id, channel_id):
+        future = comment_executor.submit(run_with_key, 'commentThreads.list', get_video_comments, video_id, channel_id, comment_attrs,
+                                         comment_limit, journal, comment_writer, include_replies, reply_executor, latest_comments.get(video_id))
+        future.add_done_callback(lambda future: comments_done(future, video_id))
+        if queue is not None:
+            comment_jobs[video_id] = future
+
+    # Write a video row and record the video as done
+    def save_video(video_data):
+        video_writer.write(video_data)
+        journal.mark_done('video', video_data['video_id'])
+
+    # Write the rows of finished videos and record them as done
+    def save_results(idxs, results):
+        for idx, video_data in zip(idxs, results):
+            # Update video data
+            if video_data:
+                video_data['video_id'] = video_ids[idx]  # Add video id to video_data
+
+                # Remember the channel for the channel stage
+                if video_data.get('channel_id'):
+                    with channel_ids_lock:
+                        channel_ids.add(video_data['channel_id'])
+                    if queue is not None:
+                        video_channels[video_ids[idx]] = video_data['channel_id']
+
+                # Queue the comments, recorded first so a resumed run still collects them
+                if comment_executor is not None:
+                    if not journal.last_entry('comment_page', video_ids[idx]):
+                        journal.record('comment_page', video_ids[idx], channel=video_data.get('channel_id'))
+                    queue_comments(video_ids[idx], video_data.get('channel_id'))
+
+                # Translated rows are written and marked done by the pipeline
+                if video_pipeline is not None:
+                    video_pipeline.put(video_data, save_video)
+                else:
+                    save_video(video_data)
+            else:
+                journal.mark_done('video', video_ids[idx])
+            metrics.inc('youtube_videos_processed_total', status='collected' if video_data else 'skipped')
+        pbar.update(len(idxs))
+
+    # Collect the videos at the given positions of video_ids with the selected engine, and continue the
+    # unfinished comments of earlier collected videos, given as (video id, channel id)
+    def collect_videos(idxs, resumed_comments=()):
+        if engine == 'asyncio':
+            # Event loop engine, always fetches videos in chunks of up to 50 ids and their comments on the same loop
+            idx_chunks = chunk_list(idxs, min(batch_size, 50))
+
+            def save_chunk(chunk_idx, results):
+                save_results(idx_chunks[chunk_idx], results)
+
+            def report_chunk(chunk_idx, exc):
+                report_error(idx_chunks[chunk_idx], exc)
+                pbar.update(len(idx_chunks[chunk_idx]))
+
+            run_async_collection(
+                scheduler,
+                [[video_ids[idx] for idx in idx_chunk] for idx_chunk in idx_chunks],
+                [[row_attrs[idx] for idx in idx_chunk] for idx_chunk in idx_chunks],
+                video_attrs, comment_attrs,
+                on_result=save_chunk,
+                on_error=report_chunk,
+                comment_limit=comment_limit, start_date=start_date, end_date=end_date, ignore_comments=ignore_comments,
+                journal=journal, comment_writer=comment_writer, include_replies=include_replies, latest_comments=latest_comments,
+                max_in_flight=max_in_flight, per_key_in_flight=per_key_in_flight, requests_per_second=requests_per_second,
+                on_comment_error=report_comment_error, resumed_comments=resumed_comments
+            )
+        else:
+            for video_id, channel_id in resumed_comments:
+                queue_comments(video_id, channel_id)
+
+            with ThreadPoolExecutor() as executor:
+                if batch_videos:
+                    # One videos().list call per chunk of up to 50 video ids
+                    future_to_video_id = {}
+                    for idx_chunk in chunk_list(idxs, min(batch_size, 50)):
+                        chunk_ids = [video_ids[idx] for idx in idx_chunk]
+                        chunk_attrs = [row_attrs[idx] for idx in idx_chunk]
+                        future = executor.submit(get_details_from_video_id_batch, chunk_ids, video_attrs, chunk_attrs, start_date, end_date)
+                        future_to_video_id[future] = idx_chunk
+                else:
+                    future_to_video_id = {
+                        executor.submit(get_details_from_video_ids, video_ids[idx], video_attrs, row_attrs[idx], comment_limit, start_date, end_date): [idx]
+                        for idx in idxs
+                    }
+
+                for future in as_completed(future_to_video_id):
+                    future_idxs = future_to_video_id.pop(future)  # Drop the finished future so its result can be freed
+                    try:
+                        # Fan the results of a batch back out into per-video rows
+                        results = future.result() if batch_videos else [future.result()]
+                    except Exception as exc:
+                        report_error(future_idxs, exc)
+                        pbar.update(len(future_idxs))
+                        continue
+                    save_results(future_idxs, results)
+
+    # Worker mode: lease batches from the work queue until it is drained. The leases are renewed in the
+    # background while a batch is collected. Finished tasks are completed, failed ones go back to the queue
+    # (and are given up after a few attempts), and tasks left over when the keys run out are released.
+    # A video is only finished once its row, its comments and its channel are saved, a channel once all its
+    # videos are finished or failed, so the tasks of a worker that dies halfway are handed out again in full.
+    def collect_from_queue():
+        kind = 'channel' if read_channel else 'video'
+        listed_kind = 'channel_uploads' if channel_source == 'uploads' else 'channel_search'
+        heartbeat = queue.start_heartbeat(kind, worker_id)
+
+        def video_finished(video_id):
+            return journal.is_done('video', video_id) and not journal.last_entry('comment_page', video_id) \
+                and (video_id not in video_channels or journal.is_done('channel', video_channels[video_id]) or keys_left)
+
+        try:
+            while not quota_exhausted:
+                if scheduler.acquire('videos.list') is None:
+                    print(f"All API keys of worker {worker_id} are exhausted.")
+                    break
 
-    # Drop duplicates if there is
-    channel_df = channel_df.drop_duplicates()
-    channel_df.to_csv(output_folder + file_name + '_channels.csv', index=False)
+                tasks = queue.lease(kind, worker_id, worker_batch_size)
+                if not tasks:
+                    if not queue.has_work(kind):
+                        break
+                    # Other workers hold the remaining tasks, wait in case their leases expire
+                    time.sleep(min(60, lease_seconds / 4))
+                    continue
+
+                task_ids = [item_id for item_id, _ in tasks]
+                first_idx = len(video_ids)
+                if read_channel:
+                    batch_video_ids = list_channel_videos(task_ids)
+                    video_ids.extend(batch_video_ids)
+                    row_attrs.extend({} for _ in batch_video_ids)
+                else:
+                    video_ids.extend(task_ids)
+                    row_attrs.extend(payload or {} for _, payload in tasks)
+
+                # Errors of an earlier attempt at these videos are settled by this one
+                for video_id in video_ids[first_idx:]:
+                    failed_errors.pop(video_id, None)
+                    comment_errors.pop(video_id, None)
+
+                idxs = [idx for idx in range(first_idx, len(video_ids)) if not journal.is_done('video', video_ids[idx])]
+                pbar.total += len(idxs)
+                pbar.refresh()
+                # Comments left unfinished by an earlier attempt of this worker are continued with the batch
+                collect_videos(idxs, unfinished_comments(video_ids[first_idx:]))
+
+                # Wait for the comment jobs of the batch. Their errors are read from the futures, the done
+                # callbacks may still be running when wait returns.
+                if comment_jobs:
+                    wait(list(comment_jobs.values()))
+                    for video_id, future in comment_jobs.items():
+                        exc = future.exception()
+                        if exc is not None and not isinstance(exc, QuotaExhaustedError):
+                            comment_errors[video_id] = exc
+                    comment_jobs.clear()
+
+                # Videos of the batch still in the translation pipeline are only marked done once their rows
+                # are written, wait for them so no task is released while it is in flight
+                if video_pipeline is not None:
+                    video_pipeline.join()
+
+                # Channels of the batch's videos, so they are in the shard before the videos are completed.
+                # Channels that are not available are not retried, the videos are completed without them.
+                collect_channel_details(sorted(channel_ids - journal.done_ids('channel')), channel_writer, journal, channel_cache, failed)
+
+                # The rows of finished videos reach the shard before the queue hears about them
+                journal.commit()
+
+                # Channels left over when the keys ran out are collected with a later lease of their videos
+                keys_left = not quota_exhausted and scheduler.acquire('videos.list') is not None
+                if read_channel:
+                    listed = {channel_id for channel_id in task_ids if journal.is_done(listed_kind, channel_id)}
+                    done = {channel_id for channel_id in listed
+                            if all(video_finished(video_id) or video_id in failed_errors or video_id in comment_errors
+                                   for video_id in journal.collected_items(listed_kind, channel_id))}
+                    failed_ids = {channel_id for channel_id in task_ids if channel_id not in listed} if keys_left else set()
+                else:
+                    done = {video_id for video_id in task_ids if video_finished(video_id)}
+                    failed_ids = {video_id for video_id in task_ids
+                                  if video_id not in done and (video_id in failed_errors or video_id in comment_errors)}
+
+                queue.complete(kind, done)
+                for item_id in failed_ids:
+                    queue.fail(kind, [item_id], failed_errors.get(item_id) or comment_errors.get(item_id) or 'channel listing failed')
+                queue.release(kind, [item_id for item_id in task_ids if item_id not in done and item_id not in failed_ids])
+        finally:
+            heartbeat.set()
+
+        print(f"Worker {worker_id} finished. Queue: {queue.stats(kind)}")
+
+    # Channel items fetched within channel_cache_days are reused instead of requested again
+    channel_cache = ItemCache(output_folder + 'channel_cache.jsonl', max_age_days=channel_cache_days)
+
+    try:
+        # Comments of videos that an earlier run collected but whose comments were not finished are continued.
+        # Workers pick these up with the batch that holds the video.
+        if queue is not None:
+            collect_from_queue()
+        else:
+            collect_videos(pending_idxs, unfinished_comments([video_id for video_id, _ in journal.pending_entries('comment_page')]))
+
+        # Wait for the comment stage to drain
+        if comment_executor is not None:
+            comment_executor.shutdown(wait=True)
+            if reply_executor is not None:
+                reply_executor.shutdown(wait=True)
+
+        # Wait for the rows still being translated
+        if video_pipeline is not None:
+            video_pipeline.close()
+        if comment_pipeline is not None:
+            comment_pipeline.close()
+
+        # Channels of videos collected by an earlier run of a resumed job
+        if resume and 'channel_id' in output_columns(video_writer.path):
+            journal.commit()
+            for chunk in read_output_chunks(video_writer.path, ['channel_id']):
+                channel_ids.update(channel_id for channel_id in chunk['channel_id'] if channel_id)
+
+        # Channel stage: distinct channels of all collected videos, 50 per request, cached across runs
+        collect_channel_details(sorted(channel_ids - journal.done_ids('channel')), channel_writer, journal, channel_cache, failed)
+        channel_cache.close()
+    finally:
+        # Flush the remaining rows, then record them as done
+        journal.close()
+        failed.close()
+        if queue is not None:
+            queue.close()
+
+    if failed.count:
+        print(f"{failed.count} items failed after retries, see {failed_path}. Run again with retry_failed=True to retry them.")
+
+    video_writer.close()
+    channel_writer.close()
 
     if not ignore_comments:
-        comments_df.to_csv(output_folder + file_name+'_comment.csv', index=False)
+        if comment_pipeline is not None:
+            comment_writer = comment_writer.writer
+        comment_writer.close()
 
         # Combine comments
-        df_combined_comments = comments_df.groupby('video_id')['comment_display'].agg(' '.join).reset_index()
-        df_combined_comments.to_csv("output_data/" + file_name + '_comment_combined.csv', index=False)
+        combined_extension = '.parquet' if output_format == 'parquet' else '.csv'
+        combine_comments(comment_writer.path, output_folder + file_name + '_comment_combined' + combined_extension)
+
+    # Persist the quota ledger for the next run
+    scheduler.save()
 
-    # Translation
+    if metrics_dump_interval:
+        metrics.dump_json(metrics_path)
+
+    # Translation of the finished files, not needed with translate_pipeline
     #translate(file_name)
 
 
@@ -557,25 +1170,89 @@ if __name__ == '__main__':
         'comment': False
     }
 
+    # Translate the translate_attrs fields while collecting into '{field}_translated' columns (True).
+    # Translate the finished files afterwards (False). Only used with the threads engine.
+    translate_pipeline = False
+    translation_workers = 8
+    # Rows waiting for translation, collection pauses while the queue is full
+    translation_queue_size = 1000
+
 
 
     # File name that contains video_ids or channel_ids
 
     # Read channel_ids (True) or read video_ids (False)
     read_channel = False
+    # How channel videos are listed: 'uploads' (uploads playlist, 1 unit per page) or 'search' (search, 100 units per page)
+    channel_source = 'uploads'
 
     # Skip comment related information (True). Collect (False)
     ignore_comments = True
     # Set the comment limit here, None for no limitation
     comment_limit = 1
+    # Number of videos whose comments are paged concurrently
+    comment_workers = 16
+    # Also collect replies (True), with a parent_id column linking them to their comment. Top-level comments only (False)
+    include_replies = False
+    # Only collect comments newer than the ones already in the comment file of an earlier run (True). All comments (False)
+    incremental_comments = False
+
+    # Only append the current view, like, comment and subscriber counts of the listed ids to
+    # output_data/{file}_stats_timeseries.csv (True). Full collection (False)
+    snapshot_statistics = False
+
+    # Reuse channel details fetched within this many days by earlier runs
+    channel_cache_days = 7
 
     # Keep the existing attributes and add the new file.
     keep_old_attr = False
 
+    # Fetch video details for up to 50 video ids per request (True). One request per video (False)
+    batch_videos = True
+    batch_size = 50
+
+    # Continue an interrupted run from its progress journal (True). Start from scratch (False)
+    resume = False
+
+    # Collection engine: 'threads' (ThreadPoolExecutor around googleapiclient) or 'asyncio' (async REST client)
+    engine = 'threads'
+    # asyncio engine limits: requests in flight overall and per key, requests started per second (None for no limit)
+    max_in_flight = 1000
+    per_key_in_flight = 100
+    requests_per_second = None
+
     # Specify your start_date and end_date here
     start_date = None #'2000-01-01'
     end_date =  None #'2023-12-31'
 
+    # Serve Prometheus metrics on this port (None to disable), and write output_data/{file}_metrics.json
+    # every metrics_dump_interval seconds (None to disable)
+    metrics_port = None
+    metrics_dump_interval = 60
+
+    # Only retry the items listed in output_data/{file}_failed.jsonl by an earlier run (True). Regular run (False)
+    retry_failed = False
+
+    # Output format: 'csv', or 'parquet' (typed, compressed columnar datasets, needs pyarrow)
+    output_format = 'csv'
+    # Partition Parquet video and comment outputs into publish_month=YYYY-MM directories
+    partition_by_month = False
+
+    # Distributed crawl over several hosts, sharing a lease-based work queue (a SQLite file every host can reach):
+    #   'coordinator'  queue the video ids (or channel ids with read_channel) of the input file and stop
+    #   'worker'       collect batches of worker_batch_size ids from the queue into output_data/{file}_{worker_id}_*.csv
+    #   'merge'        combine the shards of every worker into output_data/{file}_*.csv
+    #   None           regular single-process run
+    queue_mode = None
+    queue_path = 'output_data/work_queue.db'
+    # Defaults to host-pid. Restart a worker with the same id to continue its shard.
+    worker_id = None
+    worker_batch_size = 1000
+    # Leases of a dead worker are handed to another one after this many seconds
+    lease_seconds = 600
+    # Keys file of this host (None for keys_related/valid_api_keys.txt), so every worker can use its own subset
+    api_keys_path = None
+
     # file_name = "metadata"
     input_folder = 'input_data/'
     file = 'channel_video_ids'
@@ -587,5 +1264,13 @@ if __name__ == '__main__':
     """
 
     main(file_name = file, input_folder= input_folder, video_attrs = video_attrs, comment_attrs = comment_attrs, translate_attrs = translate_attrs, comment_limit = comment_limit,
-             ignore_comments = ignore_comments, read_channel = read_channel, start_date = start_date, end_date = end_date, keep_old_attr = keep_old_attr)
+             ignore_comments = ignore_comments, read_channel = read_channel, start_date = start_date, end_date = end_date, keep_old_attr = keep_old_attr,
+             batch_videos = batch_videos, batch_size = batch_size, resume = resume, engine = engine,
+             max_in_flight = max_in_flight, per_key_in_flight = per_key_in_flight, requests_per_second = requests_per_second,
+             channel_source = channel_source, channel_cache_days = channel_cache_days, comment_workers = comment_workers,
+             include_replies = include_replies, incremental_comments = incremental_comments, snapshot_statistics = snapshot_statistics,
+             translate_pipeline = translate_pipeline, translation_workers = translation_workers, translation_queue_size = translation_queue_size,
+             output_format = output_format, partition_by_month = partition_by_month, metrics_port = metrics_port,
+             metrics_dump_interval = metrics_dump_interval, retry_failed = retry_failed, queue_mode = queue_mode, queue_path = queue_path,
+             worker_id = worker_id, worker_batch_size = worker_batch_size, lease_seconds = lease_seconds, api_keys_path = api_keys_path)
 
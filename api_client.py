@@ -0,0 +1,57 @@
+import json
+import os
+import threading
+import httplib2
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+
+# Base URL of the API, e.g. 'http://127.0.0.1:8080/youtube/v3/' for the mock server in benchmarks/.
+# None uses the endpoint from the discovery document.
+API_ENDPOINT = os.environ.get('YOUTUBE_API_ENDPOINT')
+
+
+# Keeps one YouTube API client per (API key, thread).
+# Clients are built once from a static discovery document and every thread reuses a single
+# keep-alive HTTP connection pool for all of its clients.
+class ClientPool:
+    def __init__(self, discovery_path=None, timeout=60, api_endpoint=API_ENDPOINT):
+        self.discovery_path = discovery_path
+        self.timeout = timeout
+        self.api_endpoint = api_endpoint
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.discovery_doc = None
+
+    # Load the discovery document once per process. Uses the copy bundled with
+    # google-api-python-client unless a path to a saved document is given.
+    def discovery_document(self):
+        with self.lock:
+            if self.discovery_doc is None:
+                if self.discovery_path:
+                    with open(self.discovery_path, 'r') as f:
+                        self.discovery_doc = f.read()
+                else:
+                    self.discovery_doc = get_static_doc('youtube', 'v3')
+
+                if self.discovery_doc is None:
+                    raise RuntimeError("No static discovery document found for youtube v3")
+
+                # Parse once so every client is built from the same object
+                self.discovery_doc = json.loads(self.discovery_doc)
+
+        return self.discovery_doc
+
+    # Get the client for an API key on the calling thread, building it on first use
+    def get(self, api_key):
+        if not hasattr(self.local, 'clients'):
+            self.local.clients = {}
+            self.local.http = httplib2.Http(timeout=self.timeout)
+
+        service = self.local.clients.get(api_key)
+        if service is None:
+            client_options = {'api_endpoint': self.api_endpoint} if self.api_endpoint else None
+            service = build_from_document(self.discovery_document(), developerKey=api_key, http=self.local.http,
+                                          client_options=client_options)
+            self.local.clients[api_key] = service
+
+        return service
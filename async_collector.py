@@ -0,0 +1,334 @@
+import asyncio
+import os
+import time
+import httpx
+from quota import QuotaExhaustedError
+from metrics import metrics
+from resilience import QUOTA, PERMANENT, TRANSIENT, MAX_RETRIES, BACKOFF_BUCKETS, classify_status, parse_retry_after, backoff_delay
+from youtube_items import in_date_range, build_video_details, build_comment_details, build_reply_details, is_known_comment
+
+# Base URL of the YouTube Data API v3 REST endpoints, YOUTUBE_API_ENDPOINT points it elsewhere (e.g. the mock server)
+API_BASE_URL = os.environ.get('YOUTUBE_API_ENDPOINT', 'https://www.googleapis.com/youtube/v3/')
+
+
+# Raised when comments are disabled for a video
+class CommentsDisabledError(Exception):
+    pass
+
+
+# Reason of an API error response, e.g. 'quotaExceeded' or 'commentsDisabled'
+def error_reason(response):
+    try:
+        return response.json().get('error', {}).get('errors', [{}])[0].get('reason')
+    except (ValueError, AttributeError, IndexError):
+        return None
+
+
+# Spaces request starts so that no more than `rate` requests start per second. None means unlimited.
+class AsyncRateLimiter:
+    def __init__(self, rate=None):
+        self.rate = rate
+        self.next_start = 0
+        self.lock = asyncio.Lock()
+
+    async def wait(self):
+        if not self.rate:
+            return
+
+        loop = asyncio.get_running_loop()
+        async with self.lock:
+            now = loop.time()
+            start = max(now, self.next_start)
+            self.next_start = start + 1 / self.rate
+
+        if start > now:
+            await asyncio.sleep(start - now)
+
+
+# Async client for the Data API REST endpoints. Keys come from the QuotaScheduler; global and
+# per-key semaphores cap the requests in flight and optional rate limiters cap requests per second.
+# Rate limits, 5xx responses and network errors are retried up to max_retries times with jittered backoff.
+class AsyncYouTubeClient:
+    def __init__(self, scheduler, max_in_flight=1000, per_key_in_flight=100, requests_per_second=None,
+                 per_key_requests_per_second=None, base_url=API_BASE_URL, timeout=30, max_retries=MAX_RETRIES):
+        self.scheduler = scheduler
+        self.max_retries = max_retries
+        self.base_url = base_url
+        self.per_key_in_flight = per_key_in_flight
+        self.per_key_requests_per_second = per_key_requests_per_second
+        self.global_slots = asyncio.Semaphore(max_in_flight)
+        self.global_rate = AsyncRateLimiter(requests_per_second)
+        self.key_slots = {}
+        self.key_rates = {}
+        self.client = httpx.AsyncClient(
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=max_in_flight, max_keepalive_connections=max_in_flight)
+        )
+
+    async def close(self):
+        await self.client.aclose()
+
+    # Call a list endpoint, e.g. get('videos', part='snippet', id='abc'). Retries with another key on quota errors
+    # and after a backoff on rate limits and transient errors, same as QuotaScheduler.run.
+    async def get(self, resource, **params):
+        endpoint = resource + '.list'
+        params = {name: value for name, value in params.items() if value is not None}
+        retries = 0
+
+        while True:
+            api_key = self.scheduler.acquire(endpoint)
+            if api_key is None:
+                raise QuotaExhaustedError(f"All API keys are exhausted. Stopped at {resource}.")
+
+            if api_key not in self.key_slots:
+                self.key_slots[api_key] = asyncio.Semaphore(self.per_key_in_flight)
+                self.key_rates[api_key] = AsyncRateLimiter(self.per_key_requests_per_second)
+
+            async with self.global_slots, self.key_slots[api_key]:
+                await self.global_rate.wait()
+                await self.key_rates[api_key].wait()
+                self.scheduler.charge(api_key, endpoint)
+                start = time.perf_counter()
+                try:
+                    response = await self.client.get(self.base_url + resource, params=dict(params, key=api_key))
+                    error = None
+                except httpx.TransportError as e:
+                    response, error = None, e
+                finally:
+                    metrics.observe('youtube_api_request_seconds', time.perf_counter() - start, endpoint=endpoint)
+
+            if response is not None and response.status_code == 200:
+                metrics.inc('youtube_api_calls_total', endpoint=endpoint, status='ok')
+                self.scheduler.report_success(api_key)
+                return response.json()
+
+            if response is None:
+                error_class, retry_after = TRANSIENT, None
+            else:
+                reason = error_reason(response)
+                error_class = classify_status(response.status_code, reason, response.text)
+                retry_after = parse_retry_after(response.headers.get('retry-after'))
+
+            if error_class == QUOTA:
+                # Retire the key and retry with the next one
+                metrics.inc('youtube_api_calls_total', endpoint=endpoint, status='quota')
+                metrics.inc('youtube_api_retries_total', endpoint=endpoint, reason=QUOTA)
+                self.scheduler.mark_exhausted(api_key)
+                continue
+
+            metrics.inc('youtube_api_calls_total', endpoint=endpoint, status='error')
+            if error_class == PERMANENT:
+                if reason == 'commentsDisabled':
+                    raise CommentsDisabledError(resource)
+                response.raise_for_status()
+
+            # Rate limited or transient: rest the key if it keeps failing, back off and try again
+            self.scheduler.report_failure(api_key, retry_after)
+            if retries >= self.max_retries:
+                if error is not None:
+                    raise error
+                response.raise_for_status()
+
+            delay = backoff_delay(retries, retry_after)
+            retries += 1
+            metrics.inc('youtube_api_retries_total', endpoint=endpoint, reason=error_class)
+            metrics.observe('youtube_api_backoff_seconds', delay, BACKOFF_BUCKETS, endpoint=endpoint)
+            await asyncio.sleep(delay)
+
+
+# Collects the same video and comment records as the thread-pool path, on one event loop
+class AsyncCollector:
+    def __init__(self, client, video_attrs, comment_attrs, comment_limit=None, start_date=None,
+                 end_date=None, ignore_comments=False, journal=None, comment_writer=None, include_replies=False,
+                 latest_comments=None, on_comment_error=None):
+        self.client = client
+        self.video_attrs = video_attrs
+        self.comment_attrs = comment_attrs
+        self.comment_limit = comment_limit
+        self.start_date = start_date
+        self.end_date = end_date
+        self.ignore_comments = ignore_comments
+        self.journal = journal
+        self.comment_writer = comment_writer
+        self.include_replies = include_replies
+        self.latest_comments = latest_comments or {}
+        self.on_comment_error = on_comment_error
+        self.video_categories = None
+        self.categories_lock = asyncio.Lock()
+
+    # Fetch video categories once per run
+    async def get_video_categories(self):
+        async with self.categories_lock:
+            if self.video_categories is None:
+                categories = await self.client.get('videoCategories', part='snippet', regionCode='US')
+                self.video_categories = {item['id']: item['snippet']['title'] for item in categories['items']}
+        return self.video_categories
+
+    # Every reply of a comment thread
+    async def get_comment_replies(self, parent_id, channel_id):
+        replies = []
+        page_token = None
+
+        while True:
+            results = await self.client.get('comments', part='snippet', parentId=parent_id, maxResults=100,
+                                            pageToken=page_token, textFormat='plainText')
+            replies.extend(build_reply_details(reply, self.comment_attrs, channel_id) for reply in results['items'])
+
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                break
+
+        return replies
+
+    # Same pagination, journal and streaming behaviour as get_video_comments in the collection script
+    async def get_video_comments(self, video_id, channel_id):
+        comments = []
+        page_token = None
+        thread_count = 0
+        comment_limit = self.comment_limit
+        since = self.latest_comments.get(video_id)
+        reached_known = False
+
+        if self.journal is not None:
+            if self.journal.is_done('comment_page', video_id):
+                return comments
+
+            saved = self.journal.last_entry('comment_page', video_id)
+            page_token = saved.get('token')
+            thread_count = saved.get('count', 0)
+
+        try:
+            while comment_limit is None or thread_count < comment_limit:
+                results = await self.client.get('commentThreads', part='snippet,replies', videoId=video_id,
+                                                maxResults=100, order='time' if since else None, pageToken=page_token,
+                                                textFormat='plainText')
+
+                page = []
+                expand_ids = []
+                for item in results['items']:
+                    if since and is_known_comment(item, since):
+                        reached_known = True
+                        break
+
+                    page.append(build_comment_details(item, self.comment_attrs, channel_id, self.include_replies))
+                    thread_count += 1
+
+                    if self.include_replies:
+                        inline_replies = item.get('replies', {}).get('comments', [])
+                        if item['snippet']['totalReplyCount'] > len(inline_replies):
+                            expand_ids.append(item['id'])
+                        else:
+                            page.extend(build_reply_details(reply, self.comment_attrs, channel_id) for reply in inline_replies)
+
+                    if comment_limit is not None and thread_count >= comment_limit:
+                        break
+
+                # Expand the threads with many replies concurrently
+                for replies in await asyncio.gather(*(self.get_comment_replies(parent_id, channel_id) for parent_id in expand_ids)):
+                    page.extend(replies)
+
+                page_token = results.get('nextPageToken') if not reached_known else None
+
+                if self.comment_writer is not None:
+                    for comment_dict in page:
+                        comment_dict['video_id'] = video_id
+                    self.comment_writer.write_rows(page)
+                    if self.journal is not None and page_token:
+                        self.journal.record('comment_page', video_id, token=page_token, count=thread_count, channel=channel_id)
+                else:
+                    comments.extend(page)
+
+                if not page_token:
+                    break
+
+            if self.journal is not None:
+                self.journal.mark_done('comment_page', video_id)
+
+        except CommentsDisabledError:
+            metrics.inc('youtube_comments_disabled_total')
+            if self.journal is not None:
+                self.journal.mark_done('comment_page', video_id)
+            return None
+
+        return comments
+
+    # Collect the comments of several videos, given as (video id, channel id). A video whose comments fail is
+    # passed to on_comment_error, its unfinished pages stay in the journal for a resumed run.
+    async def collect_comments(self, videos):
+        if self.journal is not None:
+            for video_id, channel_id in videos:
+                if not self.journal.last_entry('comment_page', video_id):
+                    self.journal.record('comment_page', video_id, channel=channel_id)
+
+        results = await asyncio.gather(*(self.get_video_comments(video_id, channel_id) for video_id, channel_id in videos),
+                                       return_exceptions=True)
+        for (video_id, _), result in zip(videos, results):
+            if isinstance(result, BaseException):
+                if self.on_comment_error is None:
+                    raise result
+                self.on_comment_error(video_id, result)
+
+    # Collect a chunk of up to 50 video ids. Returns the video details per id (None when skipped), in input order.
+    # Comments of the chunk are collected before it is returned, so the chunk is only marked done once they are in.
+    # A failure of one video's comments does not fail the chunk, it is reported through on_comment_error.
+    async def collect_batch(self, video_ids, additional_attrs):
+        video_categories = await self.get_video_categories()
+        response = await self.client.get('videos', part='snippet,contentDetails,statistics,topicDetails',
+                                         id=','.join(video_ids))
+        items = {item['id']: item for item in response.get('items', [])}
+
+        results = []
+        for idx, video_id in enumerate(video_ids):
+            item = items.get(video_id)
+            if item is None:
+                print(video_id + ' is not available')
+                metrics.inc('youtube_videos_unavailable_total')
+                results.append(None)
+            elif not in_date_range(item['snippet']['publishedAt'], self.start_date, self.end_date):
+                results.append(None)
+            else:
+                video_details = build_video_details(item, self.video_attrs, video_categories)
+                video_details.update(additional_attrs[idx])
+                results.append(video_details)
+
+        if not self.ignore_comments:
+            await self.collect_comments([(video_id, video_details.get('channel_id'))
+                                         for video_id, video_details in zip(video_ids, results) if video_details])
+
+        return results
+
+
+# Run the asyncio engine over chunks of video ids. on_result(chunk, results) is called for every
+# finished chunk, on_error(chunk, exc) for every failed one and on_comment_error(video_id, exc) for every
+# video whose comments failed, all on the event loop thread. resumed_comments are (video id, channel id)
+# of collected videos whose comments an earlier run did not finish.
+def run_async_collection(scheduler, chunks, chunk_attrs, video_attrs, comment_attrs, on_result, on_error,
+                         comment_limit=None, start_date=None, end_date=None, ignore_comments=False, journal=None,
+                         comment_writer=None, include_replies=False, latest_comments=None, max_in_flight=1000, per_key_in_flight=100, requests_per_second=None,
+                         per_key_requests_per_second=None, base_url=API_BASE_URL, on_comment_error=None, resumed_comments=()):
+
+    async def collect():
+        client = AsyncYouTubeClient(scheduler, max_in_flight, per_key_in_flight, requests_per_second,
+                                    per_key_requests_per_second, base_url)
+        collector = AsyncCollector(client, video_attrs, comment_attrs, comment_limit, start_date,
+                                   end_date, ignore_comments, journal, comment_writer, include_replies, latest_comments,
+                                   on_comment_error)
+        pending = iter(range(len(chunks)))
+
+        # Each worker takes the next chunk until none are left, the semaphores bound the requests in flight
+        async def worker():
+            for chunk_idx in pending:
+                try:
+                    results = await collector.collect_batch(chunks[chunk_idx], chunk_attrs[chunk_idx])
+                    on_result(chunk_idx, results)
+                except Exception as exc:
+                    on_error(chunk_idx, exc)
+
+        try:
+            if resumed_comments and not ignore_comments:
+                await collector.collect_comments(list(resumed_comments))
+            await asyncio.gather(*(worker() for _ in range(max(1, min(max_in_flight, len(chunks))))))
+        finally:
+            await client.close()
+
+    asyncio.run(collect())
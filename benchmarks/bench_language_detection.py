@@ -0,0 +1,48 @@
+import sys
+import time
+import pandas as pd
+
+sys.path.append('.')
+from translate import calculate_english_percentage, is_english_dominant
+
+# Compare the old per-group detection with is_english_dominant on a comment corpus.
+# Run from the repository root:
+#   python benchmarks/bench_language_detection.py output_data/some_file_comment.csv comment_display [max_rows]
+
+
+# Rows per second of a detection function, and its results
+def measure(detect_func, texts):
+    start = time.perf_counter()
+    results = [detect_func(text) for text in texts]
+    elapsed = time.perf_counter() - start
+    return len(texts) / elapsed if elapsed else float('inf'), results
+
+
+# The detection used before the prefilter and whole-text path
+def per_group_english_dominant(text, threshold=0.8):
+    return calculate_english_percentage(text) >= threshold
+
+
+def main(path, column, max_rows=10000):
+    texts = pd.read_csv(path, usecols=[column], dtype=str, keep_default_na=False, nrows=max_rows)[column].tolist()
+    texts = [text.strip() for text in texts if text.strip()]
+
+    # langdetect loads its language profiles on the first call, load them before either measurement
+    is_english_dominant("Loading the language profiles")
+
+    before, before_results = measure(per_group_english_dominant, texts)
+    after, after_results = measure(is_english_dominant, texts)
+    agreement = sum(a == b for a, b in zip(before_results, after_results)) / len(texts) if texts else 1
+
+    print(f"Rows: {len(texts)}")
+    print(f"Per-group detection:   {before:10.1f} rows/sec")
+    print(f"is_english_dominant:   {after:10.1f} rows/sec ({after / before:.1f}x)")
+    print(f"Same decision on {agreement:.1%} of the rows")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print("Usage: python benchmarks/bench_language_detection.py <csv file> <text column> [max rows]")
+        sys.exit(1)
+
+    main(sys.argv[1], sys.argv[2], int(sys.argv[3]) if len(sys.argv) > 3 else 10000)
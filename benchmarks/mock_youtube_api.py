@@ -0,0 +1,310 @@
+import argparse
+import copy
+import json
+import os
+import random
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+# Local stand-in for the YouTube Data API v3, for benchmarks that must not burn real quota.
+# Responses are built from the recorded items in benchmarks/fixtures/, with ids, dates and page
+# tokens generated deterministically from the request. Latency, pagination depth, 403 quota
+# errors and 5xx errors are configurable. Point the collectors at it with
+#   YOUTUBE_API_ENDPOINT=http://127.0.0.1:<port>/youtube/v3/
+#
+# Run standalone: python benchmarks/mock_youtube_api.py --port 8080 --latency 0.05 --pages 5
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+RESOURCES = ('videos', 'channels', 'search', 'commentThreads', 'comments', 'playlistItems', 'videoCategories')
+
+# Publish dates of generated items are spread over this range
+FIRST_DATE = datetime(2010, 1, 1)
+DATE_SPAN_DAYS = 5000
+
+# Number of distinct channels the generated videos belong to
+CHANNEL_COUNT = 50
+
+QUOTA_ERROR = {
+    'error': {
+        'code': 403,
+        'message': 'The request cannot be completed because you have exceeded your <a href="/youtube/v3/getting-started#quota">quota</a>.',
+        'errors': [{'message': 'The request cannot be completed because you have exceeded your quota.',
+                    'domain': 'youtube.quota', 'reason': 'quotaExceeded'}]
+    }
+}
+
+SERVER_ERROR = {
+    'error': {
+        'code': 500,
+        'message': 'Backend Error',
+        'errors': [{'message': 'Backend Error', 'domain': 'global', 'reason': 'backendError'}]
+    }
+}
+
+
+# Stable number for a string, so the same request always gets the same response
+def stable_hash(text):
+    return zlib.crc32(text.encode('utf-8'))
+
+
+def timestamp(days):
+    return (FIRST_DATE + timedelta(days=days)).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def published_at(item_id):
+    return timestamp(stable_hash(item_id) % DATE_SPAN_DAYS)
+
+
+class MockYouTubeAPI:
+    def __init__(self, fixture_dir=FIXTURE_DIR, latency=0.0, jitter=0.0, pages=3, reply_pages=1,
+                 quota_error_rate=0.0, server_error_rate=0.0, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.pages = pages
+        self.reply_pages = reply_pages
+        self.quota_error_rate = quota_error_rate
+        self.server_error_rate = server_error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.server = None
+
+        self.fixtures = {}
+        for resource in RESOURCES:
+            with open(os.path.join(fixture_dir, resource + '.json'), 'r') as f:
+                self.fixtures[resource] = json.load(f)
+
+    # Copy of the recorded item of a resource
+    def template(self, resource, index=0):
+        items = self.fixtures[resource]
+        return copy.deepcopy(items[index % len(items)])
+
+    # Total requests served, optionally for one resource
+    def request_count(self, resource=None):
+        with self.lock:
+            if resource is not None:
+                return self.requests.get(resource, 0)
+            return sum(self.requests.values())
+
+    def reset_counts(self):
+        with self.lock:
+            self.requests = {}
+
+    # Status and body of the response to a request
+    def respond(self, resource, params):
+        with self.lock:
+            self.requests[resource] = self.requests.get(resource, 0) + 1
+            draw = self.random.random()
+
+        delay = self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay > 0:
+            time.sleep(delay)
+
+        if draw < self.quota_error_rate:
+            return 403, QUOTA_ERROR
+        if draw < self.quota_error_rate + self.server_error_rate:
+            return 500, SERVER_ERROR
+
+        handler = getattr(self, 'list_' + resource, None)
+        if handler is None:
+            return 404, {'error': {'code': 404, 'message': f'Unknown resource {resource}', 'errors': []}}
+        return 200, handler(params)
+
+    # Page number from a page token, and the token of the next page
+    def page(self, params, pages):
+        page = int(params.get('pageToken', '0') or 0)
+        next_token = str(page + 1) if page + 1 < pages else None
+        return page, next_token
+
+    def page_response(self, kind, items, next_token, total_results):
+        response = {
+            'kind': kind,
+            'etag': 'mock',
+            'pageInfo': {'totalResults': total_results, 'resultsPerPage': len(items)},
+            'items': items
+        }
+        if next_token:
+            response['nextPageToken'] = next_token
+        return response
+
+    def list_videos(self, params):
+        items = []
+        for video_id in params.get('id', '').split(','):
+            # Ids starting with 'missing' behave like private or deleted videos
+            if not video_id or video_id.startswith('missing'):
+                continue
+
+            item = self.template('videos', stable_hash(video_id))
+            item['id'] = video_id
+            item['snippet']['publishedAt'] = published_at(video_id)
+            item['snippet']['channelId'] = 'UCmock' + str(stable_hash(video_id) % CHANNEL_COUNT).zfill(18)
+            items.append(item)
+
+        return self.page_response('youtube#videoListResponse', items, None, len(items))
+
+    def list_channels(self, params):
+        items = []
+        for channel_id in params.get('id', '').split(','):
+            if not channel_id:
+                continue
+
+            item = self.template('channels', stable_hash(channel_id))
+            item['id'] = channel_id
+            item['snippet']['publishedAt'] = published_at(channel_id)
+            item['contentDetails']['relatedPlaylists']['uploads'] = 'UU' + channel_id[2:]
+            items.append(item)
+
+        return self.page_response('youtube#channelListResponse', items, None, len(items))
+
+    def list_search(self, params):
+        page, next_token = self.page(params, self.pages)
+        per_page = int(params.get('maxResults', 5))
+        query = '|'.join(params.get(name, '') for name in ('q', 'channelId', 'publishedAfter', 'publishedBefore'))
+
+        items = []
+        for i in range(per_page):
+            item = self.template('search', i)
+            video_id = 'vid' + str(stable_hash(f'{query}|{page}|{i}')).zfill(10)
+            item['id']['videoId'] = video_id
+
+            # Like the real API, the snippet is only sent when part asks for it
+            if 'snippet' in params.get('part', ''):
+                item['snippet']['publishedAt'] = published_at(video_id)
+                item['snippet']['publishTime'] = item['snippet']['publishedAt']
+                if params.get('channelId'):
+                    item['snippet']['channelId'] = params['channelId']
+            else:
+                item.pop('snippet', None)
+            items.append(item)
+
+        return self.page_response('youtube#searchListResponse', items, next_token, self.pages * per_page)
+
+    def list_commentThreads(self, params):
+        page, next_token = self.page(params, self.pages)
+        per_page = int(params.get('maxResults', 20))
+        video_id = params.get('videoId', '')
+        include_replies = 'replies' in params.get('part', '')
+
+        items = []
+        for i in range(per_page):
+            thread_id = f'{video_id}.c{page:04d}{i:03d}'
+            # Newest first, like order=time
+            published = timestamp(DATE_SPAN_DAYS - page * per_page - i)
+
+            item = self.template('commentThreads', i)
+            item['id'] = thread_id
+            item['snippet']['videoId'] = video_id
+            item['snippet']['topLevelComment']['id'] = thread_id
+            item['snippet']['topLevelComment']['snippet']['publishedAt'] = published
+            item['snippet']['topLevelComment']['snippet']['updatedAt'] = published
+
+            replies = item.pop('replies', {}).get('comments', [])
+            if include_replies and replies:
+                for reply_index, reply in enumerate(replies):
+                    reply['id'] = f'{thread_id}.r{reply_index}'
+                    reply['snippet']['parentId'] = thread_id
+                item['replies'] = {'comments': replies}
+            items.append(item)
+
+        return self.page_response('youtube#commentThreadListResponse', items, next_token, self.pages * per_page)
+
+    def list_comments(self, params):
+        page, next_token = self.page(params, self.reply_pages)
+        per_page = int(params.get('maxResults', 20))
+        parent_id = params.get('parentId', '')
+
+        items = []
+        for i in range(per_page):
+            item = self.template('comments', i)
+            item['id'] = f'{parent_id}.r{page:04d}{i:03d}'
+            item['snippet']['parentId'] = parent_id
+            items.append(item)
+
+        return self.page_response('youtube#commentListResponse', items, next_token, self.reply_pages * per_page)
+
+    def list_playlistItems(self, params):
+        page, next_token = self.page(params, self.pages)
+        per_page = int(params.get('maxResults', 5))
+        playlist_id = params.get('playlistId', '')
+
+        items = []
+        for i in range(per_page):
+            video_id = 'vid' + str(stable_hash(f'{playlist_id}|{page}|{i}')).zfill(10)
+            # Uploads are listed newest first
+            published = timestamp(DATE_SPAN_DAYS - page * per_page - i)
+
+            item = self.template('playlistItems', i)
+            item['snippet']['playlistId'] = playlist_id
+            item['snippet']['resourceId']['videoId'] = video_id
+            item['snippet']['publishedAt'] = published
+            item['contentDetails'] = {'videoId': video_id, 'videoPublishedAt': published}
+            items.append(item)
+
+        return self.page_response('youtube#playlistItemListResponse', items, next_token, self.pages * per_page)
+
+    def list_videoCategories(self, params):
+        items = copy.deepcopy(self.fixtures['videoCategories'])
+        return self.page_response('youtube#videoCategoryListResponse', items, None, len(items))
+
+    # Serve on a background thread. Returns the base URL to use as YOUTUBE_API_ENDPOINT.
+    def start(self, host='127.0.0.1', port=0):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                resource = url.path.rstrip('/').rsplit('/', 1)[-1]
+                params = {name: values[-1] for name, values in parse_qs(url.query).items()}
+
+                status, body = api.respond(resource, params)
+                payload = json.dumps(body).encode('utf-8')
+
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json; charset=UTF-8')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        ThreadingHTTPServer.daemon_threads = True
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return f'http://{host}:{self.server.server_address[1]}/youtube/v3/'
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Mock YouTube Data API v3 server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--fixtures', default=FIXTURE_DIR)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0.0, help='random extra latency, up to this many seconds')
+    parser.add_argument('--pages', type=int, default=3, help='pages of search, commentThreads and playlistItems results')
+    parser.add_argument('--reply-pages', type=int, default=1)
+    parser.add_argument('--quota-error-rate', type=float, default=0.0, help='share of requests answered with a 403 quotaExceeded')
+    parser.add_argument('--server-error-rate', type=float, default=0.0, help='share of requests answered with a 500')
+    args = parser.parse_args()
+
+    mock = MockYouTubeAPI(args.fixtures, args.latency, args.jitter, args.pages, args.reply_pages,
+                          args.quota_error_rate, args.server_error_rate)
+    print(f"Serving the mock YouTube API at {mock.start(args.host, args.port)}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        mock.stop()
@@ -0,0 +1,234 @@
+import argparse
+import importlib.util
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+# Offline benchmark suite: runs every collection mode against the mock YouTube API and reports
+# requests/sec, quota units per collected row, peak RSS and wall time. Every mode runs in its own
+# process and working directory, so RSS and quota ledgers are not shared between modes.
+#
+#   python benchmarks/run_benchmarks.py --videos 2000 --latency 0.05
+#   python benchmarks/run_benchmarks.py --output before.json
+#   python benchmarks/run_benchmarks.py --baseline before.json     # after a change, shows the differences
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# Keyword arguments of the collection script's main() for every mode
+MODES = {
+    'videos-batched': dict(batch_videos=True, ignore_comments=True),
+    'videos-single': dict(batch_videos=False, ignore_comments=True),
+    'videos-asyncio': dict(engine='asyncio', ignore_comments=True),
+    'comments': dict(batch_videos=True, ignore_comments=False, comment_limit=None),
+    'comments-replies': dict(batch_videos=True, ignore_comments=False, comment_limit=None, include_replies=True),
+    'comments-asyncio': dict(engine='asyncio', ignore_comments=False, comment_limit=None),
+    'channel-uploads': dict(read_channel=True, channel_source='uploads', ignore_comments=True),
+    'channel-search': dict(read_channel=True, channel_source='search', ignore_comments=True),
+    'snapshot-statistics': dict(snapshot_statistics=True),
+    'incremental-comments': dict(batch_videos=True, ignore_comments=False, comment_limit=None, incremental_comments=True),
+    'keyword-search': None,
+}
+
+# Modes that refresh the output of an earlier run. The earlier run is made with the given mode in the
+# same working directory first, its requests, quota and rows are not counted.
+SEED_MODES = {
+    'incremental-comments': 'comments',
+}
+
+OUTPUTS = ('video', 'channels', 'comment', 'stats_timeseries')
+
+VIDEO_ATTRS = {attr: True for attr in ('title', 'description', 'category', 'duration', 'published_date', 'channel_id', 'total_views',
+                                       'total_likes', 'total_dislikes', 'total_comments', 'video_extracted_date', 'thumbnail',
+                                       'topic_categories')}
+COMMENT_ATTRS = {attr: True for attr in ('comment_id', 'commenter_name', 'commenter_id', 'comment_display', 'comment_original',
+                                         'comment_likes', 'comment_total_replies', 'comment_published_date', 'comment_update_date',
+                                         'comment_extracted_date')}
+CHANNEL_ATTRS = {attr: True for attr in ('channel_id', 'channel_title', 'description', 'joined_date', 'location', 'total_views',
+                                         'total_subscribers', 'total_videos', 'channel_extracted_date', 'thumbnail', 'language',
+                                         'topic_categories')}
+TRANSLATE_ATTRS = {'translate': False, 'title': False, 'description': False, 'comment': False}
+
+RESULT_PREFIX = 'BENCHMARK_RESULT '
+
+
+# Data rows of a CSV output, 0 when it does not exist
+def count_rows(path):
+    if not os.path.exists(path):
+        return 0
+    import pandas as pd
+    return sum(len(chunk) for chunk in pd.read_csv(path, usecols=[0], chunksize=100000)) if os.path.getsize(path) > 0 else 0
+
+
+# Quota units charged in the working directory, read from the quota ledger
+def quota_units():
+    ledger_path = 'keys_related/quota_ledger.json'
+    if not os.path.exists(ledger_path):
+        return 0
+    with open(ledger_path, 'r') as f:
+        return sum(json.load(f).get('used', {}).values())
+
+
+# Run one mode inside the current process. Called in a fresh process by run_mode.
+def run_worker(mode, workdir, videos, keys):
+    os.chdir(workdir)
+    os.makedirs('keys_related', exist_ok=True)
+    os.makedirs('input_data', exist_ok=True)
+
+    with open('keys_related/valid_api_keys.txt', 'w') as f:
+        f.write('\n'.join(f'mock-key-{i}' for i in range(keys)))
+
+    # Quota of a seed run made before this one, and its comment rows, which a refresh appends to
+    units_before = quota_units()
+    rows_before = count_rows('output_data/bench_comment.csv') if mode in SEED_MODES else 0
+
+    start = time.perf_counter()
+
+    if mode == 'keyword-search':
+        import keyword_search
+
+        keywords = [f'benchmark keyword {i}' for i in range(max(1, videos // 500))]
+        results = keyword_search.parallel_youtube_search(keyword_search.read_api_keys('keys_related/valid_api_keys.txt'), keywords,
+                                                         '2015-01-01T00:00:00Z', '2024-01-01T00:00:00Z', window_days=365)
+        rows = len(results)
+    else:
+        options = MODES[mode]
+        with open('input_data/bench.csv', 'w') as f:
+            if options.get('read_channel'):
+                f.write('channel_id\n' + '\n'.join(f'UCbench{i:017d}' for i in range(max(1, videos // 100))) + '\n')
+            else:
+                f.write('video_id\n' + '\n'.join(f'bench{i:06d}' for i in range(videos)) + '\n')
+
+        spec = importlib.util.spec_from_file_location('youtube_data_collection', os.path.join(REPO_DIR, 'YouTube Data Collection.py'))
+        collection = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(collection)
+        collection.channel_attrs = CHANNEL_ATTRS
+
+        collection.main(file_name='bench', input_folder='input_data/', video_attrs=VIDEO_ATTRS, comment_attrs=COMMENT_ATTRS,
+                        translate_attrs=TRANSLATE_ATTRS, **options)
+        rows = sum(count_rows(f'output_data/bench_{output}.csv') for output in OUTPUTS) - rows_before
+
+    wall_time = time.perf_counter() - start
+
+    # ru_maxrss is in kilobytes on Linux
+    result = {
+        'mode': mode,
+        'wall_time': wall_time,
+        'rows': rows,
+        'quota_units': quota_units() - units_before,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+    print(RESULT_PREFIX + json.dumps(result))
+
+
+# Run a mode in a separate process against the mock server
+def run_mode(mock, endpoint, mode, videos, keys):
+    with tempfile.TemporaryDirectory() as workdir:
+        env = dict(os.environ, YOUTUBE_API_ENDPOINT=endpoint)
+
+        def run(worker_mode):
+            return subprocess.run([sys.executable, os.path.abspath(__file__), '--worker', worker_mode, '--workdir', workdir,
+                                   '--videos', str(videos), '--keys', str(keys)],
+                                  env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+
+        if mode in SEED_MODES:
+            seed = run(SEED_MODES[mode])
+            if seed.returncode != 0:
+                print(f"{mode} failed, its seed run {SEED_MODES[mode]} exited with code {seed.returncode}")
+                print(seed.stdout[-2000:])
+                return None
+
+        mock.reset_counts()
+        process = run(mode)
+
+    lines = [line for line in process.stdout.splitlines() if line.startswith(RESULT_PREFIX)]
+    if process.returncode != 0 or not lines:
+        print(f"{mode} failed with exit code {process.returncode}")
+        print(process.stdout[-2000:])
+        return None
+
+    result = json.loads(lines[-1][len(RESULT_PREFIX):])
+    result['requests'] = mock.request_count()
+    result['requests_per_sec'] = result['requests'] / result['wall_time'] if result['wall_time'] else 0
+    result['units_per_row'] = result['quota_units'] / result['rows'] if result['rows'] else None
+    return result
+
+
+def print_results(results, baseline=None):
+    columns = [('mode', '{:<18}'), ('wall_time', '{:>16.2f}'), ('requests', '{:>16}'), ('requests_per_sec', '{:>16.1f}'),
+               ('rows', '{:>16}'), ('quota_units', '{:>16}'), ('units_per_row', '{:>16.3f}'), ('peak_rss_mb', '{:>16.1f}')]
+    print(' '.join(f'{name:>16}' if i else f'{name:<18}' for i, (name, _) in enumerate(columns)))
+
+    for result in results:
+        cells = []
+        for name, cell_format in columns:
+            value = result[name]
+            cells.append(f'{"-":>16}' if value is None else cell_format.format(value))
+        print(' '.join(cells))
+
+        # Relative change against the baseline run of the same mode
+        previous = (baseline or {}).get(result['mode'])
+        if previous:
+            changes = []
+            for name in ('wall_time', 'requests_per_sec', 'units_per_row', 'peak_rss_mb'):
+                if previous.get(name) and result.get(name) is not None:
+                    changes.append(f"{name} {(result[name] - previous[name]) / previous[name]:+.1%}")
+            print(f"{'':<18} vs baseline: " + ', '.join(changes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the collectors against the mock YouTube API')
+    parser.add_argument('--modes', nargs='*', default=list(MODES), choices=list(MODES))
+    parser.add_argument('--videos', type=int, default=1000, help='video ids per run (channels and keywords are derived from it)')
+    parser.add_argument('--keys', type=int, default=10, help='mock API keys')
+    parser.add_argument('--latency', type=float, default=0.02)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--pages', type=int, default=3)
+    parser.add_argument('--quota-error-rate', type=float, default=0.0)
+    parser.add_argument('--server-error-rate', type=float, default=0.0)
+    parser.add_argument('--output', help='save the results as JSON')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    parser.add_argument('--workdir', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args.worker, args.workdir, args.videos, args.keys)
+        return
+
+    from mock_youtube_api import MockYouTubeAPI
+
+    mock = MockYouTubeAPI(latency=args.latency, jitter=args.jitter, pages=args.pages,
+                          quota_error_rate=args.quota_error_rate, server_error_rate=args.server_error_rate)
+    endpoint = mock.start()
+    print(f"Mock YouTube API at {endpoint}")
+
+    results = []
+    try:
+        for mode in args.modes:
+            print(f"Running {mode}...")
+            result = run_mode(mock, endpoint, mode, args.videos, args.keys)
+            if result is not None:
+                results.append(result)
+    finally:
+        mock.stop()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = {result['mode']: result for result in json.load(f)}
+
+    print_results(results, baseline)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+import json
+import os
+import threading
+
+
+# Append-only JSON lines journal of completed work, used to resume interrupted runs.
+# Every line is {"kind": ..., "id": ..., ...fields}, e.g.
+#   {"kind": "video", "id": "abc", "done": true}
+#   {"kind": "comment_page", "id": "abc", "token": "QURT...", "count": 200}
+#   {"kind": "search", "id": "some keyword|2010-01-01T00:00:00Z|2011-01-01T00:00:00Z", "token": "CDIQAA", "items": ["abc", "def"]}
+#
+# Entries are buffered and only reach disk in commit(), right after the registered writers
+# have flushed their rows, so the journal never claims work whose rows were not saved.
+class ProgressJournal:
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.lock = threading.RLock()
+        self.writers = []
+        self.buffer = []
+        self.done = {}
+        self.last = {}
+        self.items = {}
+
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+
+        if resume:
+            self.replay()
+        elif os.path.exists(path):
+            os.remove(path)
+
+        self.file = open(path, 'a')
+
+    # Rebuild the progress state from an existing journal
+    def replay(self):
+        if not os.path.exists(self.path):
+            return
+
+        with open(self.path, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A crash can leave the last line half written
+                    continue
+                self._apply(entry)
+
+    def _apply(self, entry):
+        kind = entry.pop('kind')
+        item_id = entry.pop('id')
+
+        if entry.pop('done', False):
+            self.done.setdefault(kind, set()).add(item_id)
+            self.last.pop((kind, item_id), None)
+        elif entry:
+            self.last[(kind, item_id)] = {key: value for key, value in entry.items() if key != 'items'}
+
+        if 'items' in entry:
+            self.items.setdefault((kind, item_id), []).extend(entry['items'])
+
+    # Register a writer whose rows must be flushed before the journal is committed
+    def add_writer(self, writer):
+        self.writers.append(writer)
+
+    # Record progress. Without registered writers the entry is committed immediately.
+    def record(self, kind, item_id, **fields):
+        entry = dict(kind=kind, id=item_id, **fields)
+        with self.lock:
+            self.buffer.append(entry)
+            self._apply(dict(entry))
+            if not self.writers:
+                self.commit()
+
+    # Mark an item as completed
+    def mark_done(self, kind, item_id):
+        self.record(kind, item_id, done=True)
+
+    def is_done(self, kind, item_id):
+        return item_id in self.done.get(kind, ())
+
+    # All ids of a kind that are completed
+    def done_ids(self, kind):
+        return set(self.done.get(kind, ()))
+
+    # Fields of the latest unfinished entry, e.g. the next page token
+    def last_entry(self, kind, item_id):
+        return self.last.get((kind, item_id), {})
+
+    # (id, fields) of every unfinished item of a kind
+    def pending_entries(self, kind):
+        return [(item_id, fields) for (entry_kind, item_id), fields in list(self.last.items()) if entry_kind == kind]
+
+    # Every 'items' list recorded for an item, concatenated
+    def collected_items(self, kind, item_id):
+        return list(self.items.get((kind, item_id), []))
+
+    # Flush the writers, then append the buffered entries to the journal
+    def commit(self):
+        with self.lock:
+            for writer in self.writers:
+                writer.flush()
+
+            for entry in self.buffer:
+                self.file.write(json.dumps(entry) + '\n')
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.buffer = []
+
+    def close(self):
+        self.commit()
+        self.file.close()
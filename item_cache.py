@@ -0,0 +1,51 @@
+import json
+import os
+import threading
+from datetime import datetime, timedelta
+
+
+# Append-only JSON lines cache of raw API items keyed by id, shared across runs.
+# Entries older than max_age_days are ignored, so statistics are refreshed periodically.
+class ItemCache:
+    def __init__(self, path, max_age_days=7):
+        self.path = path
+        self.max_age = timedelta(days=max_age_days) if max_age_days is not None else None
+        self.lock = threading.Lock()
+        self.items = {}
+
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.items[entry['id']] = entry
+
+        self.file = open(path, 'a')
+
+    # Cached item and the time it was fetched, or (None, None) when missing or expired
+    def get(self, item_id):
+        entry = self.items.get(item_id)
+        if entry is None:
+            return None, None
+
+        fetched_at = datetime.fromisoformat(entry['fetched_at'])
+        if self.max_age is not None and datetime.now() - fetched_at > self.max_age:
+            return None, None
+
+        return entry['item'], entry['fetched_at']
+
+    def put(self, item_id, item):
+        entry = {'id': item_id, 'fetched_at': datetime.now().isoformat(), 'item': item}
+        with self.lock:
+            self.items[item_id] = entry
+            self.file.write(json.dumps(entry) + '\n')
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
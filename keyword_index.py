@@ -0,0 +1,83 @@
+import os
+import sqlite3
+import threading
+from datetime import datetime
+import pandas as pd
+
+
+# Persistent SQLite index of keyword search results, kept across runs:
+#   videos(video_id, first_seen)                     every video found by any keyword
+#   video_keywords(video_id, keyword, first_seen)    every keyword that matched a video
+#   keyword_runs(keyword, last_end_date, last_run)   the end of the range each keyword was searched up to
+# New results are merged in place, so a video matched by several keywords keeps all of them.
+class KeywordIndex:
+    def __init__(self, path='input_data/keyword_index.db'):
+        self.path = path
+        self.lock = threading.Lock()
+
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS videos (video_id TEXT PRIMARY KEY, first_seen TEXT)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS video_keywords (video_id TEXT, keyword TEXT, first_seen TEXT, "
+                              "PRIMARY KEY (video_id, keyword))")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS video_keywords_keyword ON video_keywords (keyword)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS keyword_runs (keyword TEXT PRIMARY KEY, last_end_date TEXT, last_run TEXT)")
+
+    # Add the video ids found for a keyword. Already known pairs keep their first_seen.
+    # Returns the number of videos that were not in the index before.
+    def merge(self, keyword, video_ids):
+        now = datetime.now().isoformat()
+        rows = [(video_id, now) for video_id in dict.fromkeys(video_ids)]
+
+        with self.lock, self.conn:
+            before = self.conn.total_changes
+            self.conn.executemany("INSERT OR IGNORE INTO videos (video_id, first_seen) VALUES (?, ?)", rows)
+            new_videos = self.conn.total_changes - before
+            self.conn.executemany("INSERT OR IGNORE INTO video_keywords (video_id, keyword, first_seen) VALUES (?, ?, ?)",
+                                  [(video_id, keyword, first_seen) for video_id, first_seen in rows])
+        return new_videos
+
+    # End of the range the keyword was last searched up to, None if it was never searched
+    def last_end_date(self, keyword):
+        with self.lock:
+            row = self.conn.execute("SELECT last_end_date FROM keyword_runs WHERE keyword = ?", (keyword,)).fetchone()
+        return row[0] if row else None
+
+    # Where a new search of the keyword has to start: right after its last run, or at start_date
+    def next_start(self, keyword, start_date):
+        last_end_date = self.last_end_date(keyword)
+        return max(start_date, last_end_date) if last_end_date else start_date
+
+    # Remember that the keyword is searched completely up to end_date
+    def record_run(self, keyword, end_date):
+        with self.lock, self.conn:
+            self.conn.execute("INSERT INTO keyword_runs (keyword, last_end_date, last_run) VALUES (?, ?, ?) "
+                              "ON CONFLICT (keyword) DO UPDATE SET last_end_date = max(last_end_date, excluded.last_end_date), "
+                              "last_run = excluded.last_run",
+                              (keyword, end_date, datetime.now().isoformat()))
+
+    # Write one row per video as (keyword, video_id), the keyword being the one that found the video first.
+    # With keywords, only videos matched by one of them are exported.
+    def export_csv(self, path, keywords=None):
+        query = ("SELECT keyword, video_id FROM video_keywords AS vk "
+                 "WHERE keyword = (SELECT keyword FROM video_keywords WHERE video_id = vk.video_id {filter} "
+                 "ORDER BY first_seen, keyword LIMIT 1)")
+        params = []
+        if keywords is not None:
+            placeholders = ','.join('?' * len(keywords))
+            query = query.format(filter=f"AND keyword IN ({placeholders})")
+            params = list(keywords)
+        else:
+            query = query.format(filter="")
+
+        with self.lock:
+            df = pd.read_sql_query(query + " ORDER BY video_id", self.conn, params=params)
+        df.to_csv(path, index=False)
+        return len(df)
+
+    def close(self):
+        self.conn.close()
@@ -1,79 +1,299 @@
 import datetime
+import os
+import time
 import pandas as pd
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, wait, as_completed, FIRST_COMPLETED
 from tqdm import tqdm
+from quota import QuotaScheduler, QuotaExhaustedError
+from api_client import ClientPool
+from checkpoint import ProgressJournal
+from keyword_index import KeywordIndex
+from resilience import FailedItems
+from work_queue import WorkQueue, default_worker_id
+
+# Reuses one client per (API key, thread), built from the static discovery document
+client_pool = ClientPool()
 
 # Function to initialize YouTube API client
 def initialize_youtube_api(api_key):
-    return build('youtube', 'v3', developerKey=api_key, cache_discovery=False)
+    return client_pool.get(api_key)
+
+# The search API stops returning results after about this many per query
+SEARCH_RESULT_CAP = 500
+
+# Windows shorter than this are not split any further
+MIN_WINDOW = datetime.timedelta(hours=1)
+
+# Timestamp format of publishedAfter and publishedBefore
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+# Split a date range into windows of window_days days, as (start, end) timestamp pairs
+def split_date_range(start_date, end_date, window_days):
+    start = datetime.datetime.strptime(start_date, TIMESTAMP_FORMAT)
+    end = datetime.datetime.strptime(end_date, TIMESTAMP_FORMAT)
+
+    windows = []
+    while start < end:
+        window_end = min(start + datetime.timedelta(days=window_days), end)
+        windows.append((start.strftime(TIMESTAMP_FORMAT), window_end.strftime(TIMESTAMP_FORMAT)))
+        start = window_end
+    return windows
 
-# Function to search YouTube and return video IDs for a given keyword
-def youtube_search(keyword, api_key, start_date, end_date):
-    youtube = initialize_youtube_api(api_key)
+# Split a window into two halves. Returns None when the window is too short to split.
+def bisect_window(start_date, end_date):
+    start = datetime.datetime.strptime(start_date, TIMESTAMP_FORMAT)
+    end = datetime.datetime.strptime(end_date, TIMESTAMP_FORMAT)
+    if end - start < 2 * MIN_WINDOW:
+        return None
+
+    middle = (start + (end - start) / 2).replace(microsecond=0).strftime(TIMESTAMP_FORMAT)
+    return [(start_date, middle), (middle, end_date)]
+
+# Function to search YouTube and return video IDs for a given keyword within a date window.
+# Every page is charged to the key with the most quota left, so one keyword can span several keys.
+# With a journal, every page is recorded with its video IDs and the next page token, under 'keyword|start|end'.
+# With split_at, a window whose first page reports more matches than split_at is not paged further:
+# the halves of the window are returned instead, so they can be searched as separate tasks.
+# Rate limits and transient errors are retried with backoff. A window that still fails is recorded in failed,
+# if given, and a resumed search continues it from its saved page token.
+# Returns (keyword, video_ids, sub_windows, complete), complete being False when the search stopped early.
+def youtube_search(keyword, scheduler, start_date, end_date, journal=None, split_at=None, failed=None):
     video_ids = []
+    task_id = f"{keyword}|{start_date}|{end_date}"
 
-    try:
-        # Starting the search from the beginning
-        next_page_token = None
+    # Starting the search from the beginning
+    next_page_token = None
+
+    # Reuse a finished search, or continue an interrupted one from its saved page token
+    if journal is not None:
+        video_ids = journal.collected_items('search', task_id)
+        if journal.is_done('search', task_id):
+            sub_windows = bisect_window(start_date, end_date) if journal.is_done('search_split', task_id) else None
+            return keyword, video_ids, sub_windows or [], True
+        next_page_token = journal.last_entry('search', task_id).get('token')
+
+    # One page with the key that has the most quota left, retried on another key after quota errors
+    def search_page(api_key):
+        youtube = initialize_youtube_api(api_key)
+        return scheduler.execute(youtube.search().list(
+            q=keyword,
+            part="id",
+            maxResults=50,
+            order="relevance",  # Sorting by relevance
+            type="video",
+            publishedAfter=start_date,
+            publishedBefore=end_date,
+            pageToken=next_page_token
+        ))
 
+    try:
         while True:
-            request = youtube.search().list(
-                q=keyword,
-                part="id",
-                maxResults=50,
-                order="relevance",  # Sorting by relevance
-                type="video",
-                publishedAfter=start_date,
-                publishedBefore=end_date,
-                pageToken=next_page_token
-            )
-
-            response = request.execute()
+            response = scheduler.run('search.list', search_page)
 
             # Extracting video IDs from the search results
-            for item in response.get('items', []):
-                video_ids.append(item['id']['videoId'])
+            page_ids = [item['id']['videoId'] for item in response.get('items', [])]
+            video_ids.extend(page_ids)
 
             next_page_token = response.get('nextPageToken')
 
+            # Too many matches for one query, search the halves of the window instead
+            sub_windows = None
+            if split_at is not None and next_page_token and response.get('pageInfo', {}).get('totalResults', 0) > split_at:
+                sub_windows = bisect_window(start_date, end_date)
+            if sub_windows:
+                if journal is not None:
+                    journal.record('search_split', task_id, done=True)
+                    journal.record('search', task_id, items=page_ids, done=True)
+                return keyword, video_ids, sub_windows, True
+
+            if journal is not None:
+                if next_page_token:
+                    journal.record('search', task_id, token=next_page_token, items=page_ids)
+                else:
+                    journal.record('search', task_id, items=page_ids, done=True)
+
             if not next_page_token:
                 break
 
-    except HttpError as e:
-        print(f"An HTTP error occurred: {e.resp.status} {e.content}")
+    except QuotaExhaustedError:
+        print(f"All API keys are exhausted. Stopping search for '{keyword}'.")
+        return keyword, video_ids, [], False
     except Exception as e:
-        print(f"An error occurred: {e}")
+        print(f"Search for '{keyword}' failed: {e}")
+        if failed is not None:
+            failed.record('search', task_id, e)
+        return keyword, video_ids, [], False
 
-    return keyword, video_ids
+    return keyword, video_ids, [], True
 
 
 # Reading API keys from a file
 def read_api_keys(file_path):
     with open(file_path, 'r') as file:
-        return [key.strip() for key in file.readlines()]
+        return [key.strip() for key in file.readlines() if key.strip()]
 
-# Function to perform parallel searches
-def parallel_youtube_search(api_keys, keywords, start_date, end_date):
+# Function to perform parallel searches.
+# With window_days, the date range of every keyword is split into windows of that many days and windows
+# that hit the result cap are bisected adaptively. Every (keyword, window) is a separate task on one shared
+# pool, and keys are shared through the scheduler.
+# With an index, results are merged into it as they arrive and every keyword is only searched from the end
+# of its previous run. Keywords whose windows all finished are recorded as searched up to end_date.
+# Windows that fail after the retries are recorded in failed, if given.
+def parallel_youtube_search(api_keys, keywords, start_date, end_date, journal=None, window_days=None, max_workers=None, index=None,
+                            failed=None):
     search_results = []
-    with ThreadPoolExecutor(max_workers=len(api_keys)) as executor:
-        # Create a future for each keyword with different API keys
+    seen = set()
+    incomplete = set()
+    scheduler = QuotaScheduler(api_keys)
+    split_at = SEARCH_RESULT_CAP if window_days else None
+
+    # Windows of every keyword, starting after its last run when an index is given
+    keyword_windows = {}
+    for keyword in keywords:
+        keyword_start = index.next_start(keyword, start_date) if index is not None else start_date
+        if keyword_start >= end_date:
+            print(f"'{keyword}' is already searched up to {end_date}.")
+            continue
+        keyword_windows[keyword] = split_date_range(keyword_start, end_date, window_days) if window_days else [(keyword_start, end_date)]
+
+    with ThreadPoolExecutor(max_workers=max_workers or len(api_keys)) as executor:
+        # Create a future for each (keyword, window)
         futures = {
-            executor.submit(youtube_search, keyword, api_key, start_date, end_date): keyword
-            for keyword, api_key in zip(keywords, api_keys)
+            executor.submit(youtube_search, keyword, scheduler, window_start, window_end, journal, split_at, failed): keyword
+            for keyword, windows in keyword_windows.items() for window_start, window_end in windows
         }
+        pbar = tqdm(total=len(futures), desc="Collecting video IDs")
 
-        # Collecting results as they complete
-        for future in tqdm(as_completed(futures), total=len(futures), desc="Collecting video IDs"):
-            try:
-                keyword, video_ids = future.result()
+        # Collecting results as they complete, split windows are queued as new tasks
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                keyword = futures.pop(future)
+                pbar.update()
+                try:
+                    keyword, video_ids, sub_windows, complete = future.result()
+                except Exception as e:
+                    print(f"Error collecting results: {e}")
+                    incomplete.add(keyword)
+                    continue
+
+                if not complete:
+                    incomplete.add(keyword)
+                if index is not None:
+                    index.merge(keyword, video_ids)
+
+                # Windows overlap at their boundaries
                 for video_id in video_ids:
-                    search_results.append({'keyword': keyword, 'video_id': video_id})
-            except Exception as e:
-                print(f"Error collecting results: {e}")
+                    if (keyword, video_id) not in seen:
+                        seen.add((keyword, video_id))
+                        search_results.append({'keyword': keyword, 'video_id': video_id})
+
+                for window_start, window_end in sub_windows:
+                    futures[executor.submit(youtube_search, keyword, scheduler, window_start, window_end, journal, split_at, failed)] = keyword
+                pbar.total += len(sub_windows)
+                pbar.refresh()
+
+        pbar.close()
+
+    if index is not None:
+        for keyword in keyword_windows:
+            if keyword not in incomplete:
+                index.record_run(keyword, end_date)
+
+    # Persist the quota ledger for the next run
+    scheduler.save()
     return search_results
 
+# Coordinator of a distributed search: queue every (keyword, window) as a task 'keyword|start|end'.
+# With an index, every keyword only gets the windows after its last run. Returns the number of new tasks.
+def enqueue_search(queue, keywords, start_date, end_date, window_days=None, index=None):
+    tasks = []
+    for keyword in keywords:
+        keyword_start = index.next_start(keyword, start_date) if index is not None else start_date
+        if keyword_start >= end_date:
+            print(f"'{keyword}' is already searched up to {end_date}.")
+            continue
+
+        windows = split_date_range(keyword_start, end_date, window_days) if window_days else [(keyword_start, end_date)]
+        tasks.extend((f"{keyword}|{window_start}|{window_end}",
+                      {'keyword': keyword, 'start': window_start, 'end': window_end, 'run_end': end_date})
+                     for window_start, window_end in windows)
+
+    return queue.enqueue('search', tasks)
+
+# Worker of a distributed search: lease windows from the queue and search them with this host's keys, appending
+# (keyword, video_id) rows to input_data/keyword_search_{worker_id}.csv. Windows over the result cap are split
+# into new tasks for any worker. Incomplete windows are released when the keys run out and failed otherwise.
+def run_search_worker(queue, worker_id, api_keys, journal=None, split=True, failed=None, max_workers=None):
+    scheduler = QuotaScheduler(api_keys)
+    split_at = SEARCH_RESULT_CAP if split else None
+    shard_path = f"input_data/keyword_search_{worker_id}.csv"
+    max_workers = max_workers or len(api_keys)
+    heartbeat = queue.start_heartbeat('search', worker_id)
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while scheduler.acquire('search.list') is not None:
+                tasks = queue.lease('search', worker_id, max_workers)
+                if not tasks:
+                    if not queue.has_work('search'):
+                        break
+                    # Other workers hold the remaining windows, wait in case their leases expire
+                    time.sleep(min(60, queue.lease_seconds / 4))
+                    continue
+
+                futures = {executor.submit(youtube_search, payload['keyword'], scheduler, payload['start'], payload['end'],
+                                           journal, split_at, failed): (item_id, payload) for item_id, payload in tasks}
+                rows = []
+                done, incomplete = [], []
+                for future in as_completed(futures):
+                    item_id, payload = futures[future]
+                    keyword, video_ids, sub_windows, complete = future.result()
+
+                    rows.extend({'keyword': keyword, 'video_id': video_id} for video_id in dict.fromkeys(video_ids))
+                    queue.enqueue('search', [(f"{keyword}|{window_start}|{window_end}", dict(payload, start=window_start, end=window_end))
+                                             for window_start, window_end in sub_windows])
+                    (done if complete else incomplete).append(item_id)
+
+                # The rows reach the shard before the queue hears about them
+                if rows:
+                    pd.DataFrame(rows).to_csv(shard_path, mode='a', header=not os.path.exists(shard_path), index=False)
+
+                queue.complete('search', done)
+                if scheduler.acquire('search.list') is None:
+                    queue.release('search', incomplete)
+                else:
+                    queue.fail('search', incomplete, 'search stopped early')
+    finally:
+        heartbeat.set()
+        scheduler.save()
+
+    print(f"Worker {worker_id} finished. Queue: {queue.stats('search')}")
+
+# Merge the shards of every search worker into the index. Keywords whose windows are all done are
+# recorded as searched up to the end date they were queued with.
+def merge_search_shards(queue, index):
+    for worker_id in queue.workers('search'):
+        shard_path = f"input_data/keyword_search_{worker_id}.csv"
+        if not os.path.exists(shard_path):
+            continue
+        for chunk in pd.read_csv(shard_path, dtype=str, chunksize=100000):
+            for keyword, group in chunk.groupby('keyword'):
+                index.merge(keyword, group['video_id'].tolist())
+
+    finished = {}
+    run_ends = {}
+    for _, payload, status in queue.items('search'):
+        keyword = payload['keyword']
+        finished[keyword] = finished.get(keyword, True) and status == 'done'
+        run_ends[keyword] = max(run_ends.get(keyword, payload['run_end']), payload['run_end'])
+
+    for keyword, complete in finished.items():
+        if complete:
+            index.record_run(keyword, run_ends[keyword])
+        else:
+            print(f"'{keyword}' still has unfinished windows.")
+
 def main():
     api_keys_file_path = 'keys_related/valid_api_keys.txt'
     api_keys = read_api_keys(api_keys_file_path)
@@ -84,21 +304,73 @@ def main():
     start_date = "2010-01-01T00:00:00Z"
     end_date = "2024-07-01T00:00:00Z"
 
-    results = parallel_youtube_search(api_keys, keywords, start_date, end_date)
+    # Search the range in windows of this many days, bisecting windows with more than SEARCH_RESULT_CAP matches.
+    # None searches the whole range with one query per keyword.
+    window_days = 365
+
+    # Continue an interrupted search from its progress journal (True). Start from scratch (False)
+    resume = False
+
+    # Results of every run are merged into the index, keywords are only searched after their last run
+    index = KeywordIndex("input_data/keyword_index.db")
+
+    # Distributed search over several hosts, sharing a lease-based work queue (a SQLite file every host can reach):
+    #   'coordinator'  queue the (keyword, window) tasks and stop
+    #   'worker'       search queued windows with this host's keys (api_keys_file_path) into input_data/keyword_search_{worker_id}.csv
+    #   'merge'        add the shards of every worker to the index and export it
+    #   None           regular single-process search
+    queue_mode = None
+    queue_path = "input_data/keyword_search_queue.db"
+    # Defaults to host-pid. Restart a worker with the same id to continue from its journal.
+    worker_id = None
+
+    if queue_mode == 'coordinator':
+        queue = WorkQueue(queue_path)
+        added = enqueue_search(queue, keywords, start_date, end_date, window_days, index)
+        print(f"Queued {added} new search windows: {queue.stats('search')}")
+        queue.close()
+        index.close()
+        return
+
+    if queue_mode == 'worker':
+        worker_id = worker_id or default_worker_id()
+        queue = WorkQueue(queue_path)
+        journal = ProgressJournal(f"input_data/keyword_search_journal_{worker_id}.jsonl", resume=True)
+        failed = FailedItems(f"input_data/keyword_search_failed_{worker_id}.jsonl")
+        run_search_worker(queue, worker_id, api_keys, journal, split=window_days is not None, failed=failed)
+        journal.close()
+        failed.close()
+        queue.close()
+        index.close()
+        return
 
-    # Save results to a single CSV file
-    df = pd.DataFrame(results)
+    if queue_mode == 'merge':
+        queue = WorkQueue(queue_path)
+        merge_search_shards(queue, index)
+        queue.close()
+        exported = index.export_csv("input_data/New_SCS_YT_regular_video.csv", keywords)
+        print(f"Exported {exported} videos.")
+        index.close()
+        return
 
-    len1 = len(df)
+    journal = ProgressJournal("input_data/keyword_search_journal.jsonl", resume=resume)
 
-    df.drop_duplicates(subset=['video_id'], keep=False,inplace=True)
+    # Windows that still fail after the retries, resuming the search retries them from their saved page
+    failed = FailedItems("input_data/keyword_search_failed.jsonl")
 
-    len2 = len(df)
+    results = parallel_youtube_search(api_keys, keywords, start_date, end_date, journal, window_days, index=index, failed=failed)
+    journal.close()
+    failed.close()
 
-    print("Dropped:" + str(len1-len2))
+    if failed.count:
+        print(f"{failed.count} search windows failed, see input_data/keyword_search_failed.jsonl. Run again with resume=True.")
 
+    print(f"Found {len(results)} keyword matches in this run.")
 
-    df.to_csv("input_data/New_SCS_YT_regular_video.csv", index=False)
+    # Export one row per video matched by the keywords
+    exported = index.export_csv("input_data/New_SCS_YT_regular_video.csv", keywords)
+    print(f"Exported {exported} videos.")
+    index.close()
 
 if __name__ == "__main__":
     main()
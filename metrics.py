@@ -0,0 +1,154 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+# Short label for an API key, so keys never end up in metric output
+def key_label(api_key):
+    return '...' + api_key[-4:] if api_key else 'none'
+
+
+# Process-wide counters and histograms of a crawl, identified by a name and labels, e.g.
+#   metrics.inc('youtube_api_calls_total', endpoint='videos.list', status='ok')
+#   metrics.observe('youtube_api_request_seconds', 0.21, endpoint='videos.list')
+# Exported as Prometheus text over HTTP (start_http_server) or as a periodic JSON dump (start_json_dump).
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {'buckets': buckets, 'counts': [0] * len(buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram['counts'][i] += 1
+                    break
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    # Time the enclosed block into a histogram
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    # Current value of a counter, summed over every label set that contains the given labels
+    def value(self, name, **labels):
+        with self.lock:
+            return sum(value for (counter_name, counter_labels), value in self.counters.items()
+                       if counter_name == name and set(labels.items()) <= set(counter_labels))
+
+    # All metrics as a JSON-serializable dict. Row counters also get a per-second rate over the uptime.
+    def snapshot(self):
+        uptime = time.time() - self.started
+        with self.lock:
+            counters = [{'name': name, 'labels': dict(labels), 'value': value}
+                        for (name, labels), value in sorted(self.counters.items())]
+            histograms = [{'name': name, 'labels': dict(labels), 'buckets': list(histogram['buckets']),
+                           'counts': list(histogram['counts']), 'sum': histogram['sum'], 'count': histogram['count']}
+                          for (name, labels), histogram in sorted(self.histograms.items())]
+
+        rows_per_second = {counter['labels'].get('output'): counter['value'] / uptime if uptime else 0
+                           for counter in counters if counter['name'] == 'output_rows_total'}
+
+        return {'time': time.time(), 'uptime_seconds': uptime, 'counters': counters, 'histograms': histograms,
+                'rows_per_second': rows_per_second}
+
+    # All metrics in the Prometheus text exposition format
+    def prometheus_text(self):
+        def format_labels(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ''
+            return '{' + ','.join(f'{name}="{str(value)}"' for name, value in pairs) + '}'
+
+        lines = []
+        with self.lock:
+            typed = set()
+            for (name, labels), value in sorted(self.counters.items()):
+                if name not in typed:
+                    lines.append(f'# TYPE {name} counter')
+                    typed.add(name)
+                lines.append(f'{name}{format_labels(labels)} {value}')
+
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                if name not in typed:
+                    lines.append(f'# TYPE {name} histogram')
+                    typed.add(name)
+                cumulative = 0
+                for bound, count in zip(histogram['buckets'], histogram['counts']):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{format_labels(labels, [("le", bound)])} {cumulative}')
+                lines.append(f'{name}_bucket{format_labels(labels, [("le", "+Inf")])} {histogram["count"]}')
+                lines.append(f'{name}_sum{format_labels(labels)} {histogram["sum"]}')
+                lines.append(f'{name}_count{format_labels(labels)} {histogram["count"]}')
+
+        return '\n'.join(lines) + '\n'
+
+    # Serve the Prometheus text at http://host:port/metrics on a background thread
+    def start_http_server(self, port, host='0.0.0.0'):
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                payload = registry.prometheus_text().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        print(f"Serving metrics at http://{host}:{server.server_address[1]}/metrics")
+        return server
+
+    # Write the snapshot to a JSON file
+    def dump_json(self, path):
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.snapshot(), f, indent=2)
+        os.replace(tmp_path, path)
+
+    # Write the snapshot to a JSON file every `interval` seconds on a background thread
+    def start_json_dump(self, path, interval=60):
+        def dump_loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.dump_json(path)
+                except OSError as e:
+                    print(f"Could not write metrics: {e}")
+
+        threading.Thread(target=dump_loop, daemon=True).start()
+
+
+# Shared by every module of a run
+metrics = Metrics()
@@ -0,0 +1,227 @@
+import json
+import os
+import threading
+import time
+from datetime import datetime
+from urllib.parse import urlparse, parse_qs
+from zoneinfo import ZoneInfo
+from metrics import metrics, key_label
+from resilience import QUOTA, PERMANENT, RATE_LIMIT, TRANSIENT, MAX_RETRIES, BACKOFF_BUCKETS, CircuitBreaker, classify_error, backoff_delay
+
+# Quota units charged by the YouTube Data API v3 for each method
+QUOTA_COSTS = {
+    'search.list': 100,
+    'videos.list': 1,
+    'channels.list': 1,
+    'commentThreads.list': 1,
+    'comments.list': 1,
+    'playlistItems.list': 1,
+    'videoCategories.list': 1,
+}
+
+# Default daily quota of a key
+DAILY_QUOTA = 10000
+
+# The daily quota resets at midnight Pacific Time
+QUOTA_TIMEZONE = ZoneInfo('America/Los_Angeles')
+
+# Save the ledger to disk after this many charged calls
+SAVE_EVERY = 100
+
+
+# Raised by workers when every key is exhausted, so the item is not treated as finished
+class QuotaExhaustedError(Exception):
+    pass
+
+
+# Current quota day, e.g. '2024-07-01'
+def current_quota_day():
+    return datetime.now(QUOTA_TIMEZONE).strftime('%Y-%m-%d')
+
+
+# Check if an HttpError is caused by an exhausted quota
+def is_quota_error(error):
+    return classify_error(error)[0] == QUOTA
+
+
+# Quota cost of an endpoint such as 'search.list'
+def quota_cost(endpoint):
+    return QUOTA_COSTS.get(endpoint, 1)
+
+
+# Hands out API keys by remaining budget and keeps a per-key unit ledger that survives restarts.
+# Keys that keep failing with rate limits or transient errors are rested by a circuit breaker.
+class QuotaScheduler:
+    def __init__(self, api_keys, ledger_path='keys_related/quota_ledger.json', daily_quota=DAILY_QUOTA, breaker=None):
+        self.api_keys = list(api_keys)
+        self.ledger_path = ledger_path
+        self.daily_quota = daily_quota
+        self.breaker = breaker or CircuitBreaker()
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.day = current_quota_day()
+        self.used = {api_key: 0 for api_key in self.api_keys}
+        self.exhausted = set()
+        self.unsaved = 0
+        self.load()
+
+    # Load today's usage from the ledger file. Usage from an earlier quota day is discarded.
+    def load(self):
+        if not self.ledger_path or not os.path.exists(self.ledger_path):
+            return
+
+        try:
+            with open(self.ledger_path, 'r') as f:
+                ledger = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Could not read quota ledger: {e}")
+            return
+
+        if ledger.get('day') != self.day:
+            return
+
+        for api_key, units in ledger.get('used', {}).items():
+            if api_key in self.used:
+                self.used[api_key] = units
+        self.exhausted = set(ledger.get('exhausted', [])) & set(self.api_keys)
+
+    # Write the ledger to disk
+    def save(self):
+        if not self.ledger_path:
+            return
+
+        with self.lock:
+            ledger = {'day': self.day, 'used': dict(self.used), 'exhausted': sorted(self.exhausted)}
+            self.unsaved = 0
+
+        folder = os.path.dirname(self.ledger_path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+
+        # Write to a temporary file first so a crash never leaves a truncated ledger
+        with self.save_lock:
+            tmp_path = self.ledger_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(ledger, f, indent=2)
+            os.replace(tmp_path, self.ledger_path)
+
+    # Start a fresh ledger once the quota day rolls over. Must be called with the lock held.
+    def _reset_if_new_day(self):
+        day = current_quota_day()
+        if day != self.day:
+            self.day = day
+            self.used = {api_key: 0 for api_key in self.api_keys}
+            self.exhausted = set()
+
+    # Units a key can still spend today
+    def remaining(self, api_key):
+        return self.daily_quota - self.used.get(api_key, 0)
+
+    # Total units left across all usable keys
+    def total_remaining(self):
+        with self.lock:
+            self._reset_if_new_day()
+            return sum(max(self.remaining(api_key), 0) for api_key in self.api_keys if api_key not in self.exhausted)
+
+    # Pick the key with the largest remaining budget that can afford the endpoint, skipping rested keys
+    # unless every key is rested. Returns None when every key is exhausted.
+    def acquire(self, endpoint='videos.list'):
+        cost = quota_cost(endpoint)
+        with self.lock:
+            self._reset_if_new_day()
+            candidates = [api_key for api_key in self.api_keys
+                          if api_key not in self.exhausted and self.remaining(api_key) >= cost]
+            if not candidates:
+                return None
+            healthy = [api_key for api_key in candidates if not self.breaker.is_open(api_key)]
+            return max(healthy or candidates, key=self.remaining)
+
+    # Charge a key for one call to the endpoint
+    def charge(self, api_key, endpoint):
+        with self.lock:
+            self._reset_if_new_day()
+            self.used[api_key] = self.used.get(api_key, 0) + quota_cost(endpoint)
+            metrics.inc('youtube_quota_units_total', quota_cost(endpoint), key=key_label(api_key), endpoint=endpoint)
+
+            # Stop handing out the key once it cannot afford even the cheapest call
+            if self.remaining(api_key) < min(QUOTA_COSTS.values()):
+                self.exhausted.add(api_key)
+
+            self.unsaved += 1
+            save = self.unsaved >= SAVE_EVERY
+
+        if save:
+            self.save()
+
+    # Stop handing out a key for the rest of the quota day
+    def mark_exhausted(self, api_key):
+        with self.lock:
+            self.exhausted.add(api_key)
+        metrics.inc('youtube_keys_exhausted_total', key=key_label(api_key))
+        self.save()
+
+    # Report the outcome of a call to the circuit breaker of its key
+    def report_success(self, api_key):
+        self.breaker.record_success(api_key)
+
+    def report_failure(self, api_key, retry_after=None):
+        self.breaker.record_failure(api_key, retry_after)
+
+    # Charge and execute a googleapiclient request. The key and the endpoint are read from the request itself.
+    def execute(self, request):
+        api_key = parse_qs(urlparse(request.uri).query).get('key', [None])[0]
+        endpoint = request.methodId.split('.', 1)[-1]
+
+        if api_key is not None:
+            self.charge(api_key, endpoint)
+
+        start = time.perf_counter()
+        try:
+            response = request.execute()
+        except Exception as e:
+            error_class, retry_after = classify_error(e)
+            metrics.inc('youtube_api_calls_total', endpoint=endpoint, status='quota' if error_class == QUOTA else 'error')
+            if api_key is not None:
+                if error_class == QUOTA:
+                    self.mark_exhausted(api_key)
+                elif error_class in (RATE_LIMIT, TRANSIENT):
+                    self.report_failure(api_key, retry_after)
+            raise
+        finally:
+            metrics.observe('youtube_api_request_seconds', time.perf_counter() - start, endpoint=endpoint)
+
+        metrics.inc('youtube_api_calls_total', endpoint=endpoint, status='ok')
+        if api_key is not None:
+            self.report_success(api_key)
+        return response
+
+    # Run call(api_key) with the key that has the most quota left until it succeeds. Quota errors move on
+    # to the next key, rate limits and transient errors are retried after a jittered backoff (at least the
+    # Retry-After) up to max_retries times. Permanent errors and the last failure are raised.
+    def run(self, endpoint, call, max_retries=MAX_RETRIES):
+        retries = 0
+        while True:
+            api_key = self.acquire(endpoint)
+            if api_key is None:
+                raise QuotaExhaustedError(f"All API keys are exhausted. Stopped at {endpoint}.")
+            try:
+                return call(api_key)
+            except Exception as e:
+                error_class, retry_after = classify_error(e)
+
+                if error_class == QUOTA:
+                    # Calls through execute have already retired the key
+                    if api_key not in self.exhausted:
+                        self.mark_exhausted(api_key)
+                    metrics.inc('youtube_api_retries_total', endpoint=endpoint, reason=QUOTA)
+                    continue
+
+                if error_class == PERMANENT or retries >= max_retries:
+                    raise
+
+                delay = backoff_delay(retries, retry_after)
+                retries += 1
+                metrics.inc('youtube_api_retries_total', endpoint=endpoint, reason=error_class)
+                metrics.observe('youtube_api_backoff_seconds', delay, BACKOFF_BUCKETS, endpoint=endpoint)
+                print(f"{error_class} error on {endpoint}, retry {retries} of {max_retries} in {delay:.1f}s: {e}")
+                time.sleep(delay)
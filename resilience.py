@@ -0,0 +1,188 @@
+import json
+import os
+import random
+import socket
+import ssl
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from metrics import metrics, key_label
+
+try:
+    import httplib2
+    NETWORK_ERRORS = (ConnectionError, TimeoutError, socket.timeout, socket.gaierror, ssl.SSLError, httplib2.HttpLib2Error)
+except ImportError:
+    NETWORK_ERRORS = (ConnectionError, TimeoutError, socket.timeout, socket.gaierror, ssl.SSLError)
+
+# Classes of API errors:
+#   quota       the key's daily quota is spent, retire the key and move on to the next one
+#   rate_limit  too many requests for now, back off and retry
+#   transient   5xx responses and network failures, back off and retry
+#   permanent   everything else (bad request, not found, forbidden), retrying does not help
+QUOTA = 'quota'
+RATE_LIMIT = 'rate_limit'
+TRANSIENT = 'transient'
+PERMANENT = 'permanent'
+
+QUOTA_REASONS = {'quotaExceeded', 'dailyLimitExceeded'}
+RATE_LIMIT_REASONS = {'rateLimitExceeded', 'userRateLimitExceeded'}
+TRANSIENT_REASONS = {'backendError', 'internalError'}
+
+# Retries of a rate limited or transient call, and the bounds of the backoff between them in seconds
+MAX_RETRIES = 5
+BACKOFF_BASE = 1
+BACKOFF_CAP = 60
+
+# Upper bounds of the backoff histogram buckets, in seconds
+BACKOFF_BUCKETS = (0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+# Reason of an API error body, e.g. 'quotaExceeded' or 'commentsDisabled'
+def body_reason(body):
+    try:
+        return json.loads(body).get('error', {}).get('errors', [{}])[0].get('reason')
+    except (ValueError, AttributeError, IndexError):
+        return None
+
+
+# Class of an error response from its status code, reason and body
+def classify_status(status, reason=None, body=''):
+    if reason in RATE_LIMIT_REASONS:
+        return RATE_LIMIT
+    if reason in QUOTA_REASONS or (status == 403 and 'quota' in body.lower()):
+        return QUOTA
+    if status == 429:
+        return RATE_LIMIT
+    if status >= 500 or reason in TRANSIENT_REASONS:
+        return TRANSIENT
+    return PERMANENT
+
+
+# Seconds to wait from a Retry-After header, given either as seconds or as an HTTP date
+def parse_retry_after(value):
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+# (class, retry_after) of an exception raised by an API call. HttpErrors of googleapiclient
+# are classified by their response, network failures are transient and anything else is permanent.
+def classify_error(error):
+    if hasattr(error, 'resp') and hasattr(error, 'content'):
+        content = error.content
+        body = content.decode(errors='replace') if isinstance(content, bytes) else str(content)
+        retry_after = parse_retry_after(error.resp.get('retry-after')) if hasattr(error.resp, 'get') else None
+        return classify_status(error.resp.status, body_reason(body), body), retry_after
+
+    if isinstance(error, NETWORK_ERRORS):
+        return TRANSIENT, None
+
+    return PERMANENT, None
+
+
+# Seconds to wait before retry number `retry` (0 for the first): exponential with full jitter,
+# and never shorter than a Retry-After given by the server
+def backoff_delay(retry, retry_after=None, base=BACKOFF_BASE, cap=BACKOFF_CAP):
+    delay = random.uniform(0, min(cap, base * 2 ** retry))
+    if retry_after is not None:
+        delay = max(delay, retry_after + random.uniform(0, base))
+    return delay
+
+
+# Per-key circuit breaker. After failure_threshold consecutive rate limited or transient failures a key
+# is rested for cooldown seconds (or the Retry-After, if longer). The first call after the rest is a trial:
+# success closes the breaker, another failure rests the key again for twice as long, up to max_cooldown.
+class CircuitBreaker:
+    def __init__(self, failure_threshold=5, cooldown=30, max_cooldown=600):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.lock = threading.Lock()
+        self.failures = {}
+        self.cooldowns = {}
+        self.open_until = {}
+
+    def is_open(self, key):
+        return time.monotonic() < self.open_until.get(key, 0)
+
+    def record_success(self, key):
+        with self.lock:
+            self.failures.pop(key, None)
+            self.cooldowns.pop(key, None)
+            self.open_until.pop(key, None)
+
+    def record_failure(self, key, retry_after=None):
+        with self.lock:
+            self.failures[key] = self.failures.get(key, 0) + 1
+            if self.failures[key] < self.failure_threshold:
+                return
+
+            cooldown = self.cooldowns.get(key, self.cooldown)
+            rest = max(cooldown, retry_after or 0)
+            self.open_until[key] = time.monotonic() + rest
+            self.cooldowns[key] = min(cooldown * 2, self.max_cooldown)
+            # Keep the key one failure away from tripping, so a failed trial call rests it again
+            self.failures[key] = self.failure_threshold - 1
+
+        metrics.inc('youtube_circuit_breaker_trips_total', key=key_label(key))
+        print(f"Key {key_label(key)} keeps failing, resting it for {rest:.0f}s.")
+
+
+# Append-only JSON lines file of items that failed for good, for a later retry pass. Every line is
+#   {"kind": "video", "id": "abc", "error": "permanent", "message": "...", "time": "..."}
+# The file is only created once the first item fails.
+class FailedItems:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = None
+        self.count = 0
+
+    def record(self, kind, item_id, error, **fields):
+        error_class = classify_error(error)[0] if isinstance(error, BaseException) else error
+        entry = dict(kind=kind, id=item_id, error=error_class, message=str(error)[:500],
+                     time=datetime.now().isoformat(), **fields)
+
+        with self.lock:
+            if self.file is None:
+                folder = os.path.dirname(self.path)
+                if folder and not os.path.exists(folder):
+                    os.makedirs(folder)
+                self.file = open(self.path, 'a')
+            self.file.write(json.dumps(entry) + '\n')
+            self.file.flush()
+            self.count += 1
+
+        metrics.inc('youtube_failed_items_total', kind=kind, error=error_class)
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+# Latest entry of every failed item in a failed items file, optionally of one kind
+def read_failed_items(path, kind=None):
+    entries = {}
+    if not os.path.exists(path):
+        return []
+
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if kind is None or entry.get('kind') == kind:
+                entries[(entry.get('kind'), entry.get('id'))] = entry
+
+    return list(entries.values())
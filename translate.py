@@ -1,32 +1,86 @@
+import os
 import pandas as pd
 from googletrans import Translator
 from tqdm import tqdm
 import time
+import threading
+import queue
 from httpx import Timeout
-from multiprocessing import Pool
 from concurrent.futures import ThreadPoolExecutor
-from langdetect import detect, DetectorFactory
+from langdetect import detect, detect_langs, DetectorFactory
 import re
 import random
+from translation_cache import TranslationCache, text_key
+from writers import typed_frame
+from metrics import metrics
 # Creates Translator object
 def create_translator():
     translator = Translator(timeout=Timeout(10.0))
     translator.raise_Exception = True
     return translator
 
-
-def translate(translator, transcription, max_retries=5, delay=1):
+# One Translator per worker thread, its HTTP client is not shared between threads
+translator_local = threading.local()
+
+def get_translator():
+    if not hasattr(translator_local, 'translator'):
+        translator_local.translator = create_translator()
+    return translator_local.translator
+
+
+# Request rate shared by all translation workers, adapted with AIMD: every success raises the rate
+# additively (by about `increase` requests per second each second), every 429 cuts it by `decrease`.
+# Request starts are spaced 1 / rate seconds apart.
+class AdaptiveRateLimiter:
+    def __init__(self, rate=1.0, min_rate=0.1, max_rate=50.0, increase=0.5, decrease=0.5):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.next_start = time.monotonic()
+        self.lock = threading.Lock()
+
+    # Block until the next request may start
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_start)
+            self.next_start = start + 1 / self.rate
+
+        if start > now:
+            time.sleep(start - now)
+
+    def success(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.increase / self.rate)
+
+    # Back off after a 429: lower the rate and hold every worker for one interval of the new rate
+    def rate_limited(self):
+        metrics.inc('translation_backoffs_total')
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            self.next_start = max(self.next_start, time.monotonic() + 1 / self.rate + random.random())
+
+
+def translate(translator, transcription, max_retries=5):
     for retry in range(max_retries):
+        rate_limiter.wait()
+        start = time.perf_counter()
         try:
             translated_text = translator.translate(transcription, dest='en').text
+            metrics.observe('translation_request_seconds', time.perf_counter() - start)
             if translated_text:
-                time.sleep(delay)  # Introducing the delay
+                rate_limiter.success()
+                metrics.inc('translation_requests_total', status='ok')
                 return translated_text
         except Exception as e:
+            metrics.observe('translation_request_seconds', time.perf_counter() - start)
+            metrics.inc('translation_requests_total', status='rate_limited' if "429" in str(e) else 'error')
             if "429" in str(e):  # If we encounter a 429 error
-                sleep_time = (2 ** retry) + random.random()  # exponential backoff with jitter
-                print(f"Rate limit exceeded. Retrying in {sleep_time} seconds...")
-                time.sleep(sleep_time)
+                rate_limiter.rate_limited()
+                metrics.inc('translation_retries_total', reason='rate_limited')
+                print(f"Rate limit exceeded. Lowering the request rate to {rate_limiter.rate:.2f} per second...")
                 continue
             elif "JSON object must be str, bytes or bytearray" in str(e):
                 print("Received unexpected response from the translation service. Skipping this translation...")
@@ -36,12 +90,16 @@ def translate(translator, transcription, max_retries=5, delay=1):
                 return "Translation Error"
             elif retry < max_retries - 1:  # i.e. not the last retry
                 print(f"Error: {e}. Retrying...")
+                metrics.inc('translation_retries_total', reason='error')
                 time.sleep(2 ** retry)  # Exponential backoff
                 continue
             else:
                 print(f"Failed to translate after {max_retries} attempts. Error: {e}")
                 return "Translation Error"
 
+    # Every attempt was rate limited or came back empty
+    print(f"Failed to translate after {max_retries} attempts.")
+    return "Translation Error"
 
 
 
@@ -77,10 +135,84 @@ def calculate_english_percentage(text, group_size=20):
     else:
         return 0
 
-# Determines if the text is predominantly English
-def is_english_dominant(text, threshold=0.8):
+# Letters of scripts that are never English: Cyrillic, Hebrew, Arabic, Devanagari, Thai, Hangul Jamo, CJK, kana and Hangul
+NON_LATIN_LETTERS = re.compile(r'[\u0400-\u04FF\u0590-\u05FF\u0600-\u06FF\u0900-\u097F\u0E00-\u0E7F\u1100-\u11FF'
+                               r'\u3040-\u30FF\u3400-\u4DBF\u4E00-\u9FFF\uAC00-\uD7AF]')
+LETTERS = re.compile(r'[^\W\d_]')
+
+# Frequent English words, used to tell English apart from other languages written in plain ASCII.
+# Words that are also common in other languages (German 'was', 'so', 'in', 'also', Dutch 'is', 'had',
+# Spanish 'a', 'no', ...) are left out, so a few shared words cannot make German, Dutch or Spanish text look English.
+ENGLISH_WORDS = {'the', 'and', 'or', 'but', 'are', 'were', 'been', 'you', 'she', 'it', 'they', 'this', 'that', 'these', 'those',
+                 'with', 'from', 'not', 'if', 'your', 'his', 'our', 'their', 'them', 'him', 'what', 'who', 'how', 'why', 'when',
+                 'where', 'which', 'there', 'have', 'does', 'did', 'would', 'can', 'could', 'should', 'just', 'about',
+                 'very', 'really', 'much', 'more', 'some', 'all', 'one', 'only', 'than', 'because', 'out', 'get', 'make',
+                 'know', 'think', 'people', 'time', 'love', 'like', 'song', 'great', 'good', 'best', 'amazing', 'thank', 'thanks'}
+
+# Decide obvious cases from the characters alone: True for plain English, False for text without
+# letters or written only in a non-Latin script, None when a language model is needed
+def script_prefilter(text, min_english_words=0.3):
+    letters = LETTERS.findall(text)
+    if not letters:
+        return False
+
+    non_latin = len(NON_LATIN_LETTERS.findall(text))
+    if non_latin == len(letters):
+        return False
+    if non_latin:
+        return None
+
+    if text.isascii():
+        words = re.findall(r'[a-z]+', text.lower())
+        if len(words) >= 3 and sum(word in ENGLISH_WORDS for word in words) / len(words) >= min_english_words:
+            return True
+
+    return None
+
+# Non-Latin scripts and the language or script name they stand for, in the order they are checked
+# (kana before Han, so Japanese text is not taken for Chinese)
+SCRIPTS = (('ja', re.compile(r'[\u3040-\u30FF]')), ('ko', re.compile(r'[\u1100-\u11FF\uAC00-\uD7AF]')),
+           ('zh', re.compile(r'[\u3400-\u4DBF\u4E00-\u9FFF]')), ('cyrillic', re.compile(r'[\u0400-\u04FF]')),
+           ('he', re.compile(r'[\u0590-\u05FF]')), ('arabic', re.compile(r'[\u0600-\u06FF]')),
+           ('devanagari', re.compile(r'[\u0900-\u097F]')), ('th', re.compile(r'[\u0E00-\u0E7F]')))
+
+# Language (or script) of a text from its characters alone, None for Latin text
+def script_language(text):
+    for name, pattern in SCRIPTS:
+        if pattern.search(text):
+            return name
+    return None
+
+# (is the text predominantly English, its language) for a text.
+# Obvious cases are decided by script_prefilter. Single-script text is detected with one langdetect call
+# on the whole text, and only mixed or uncertain text falls back to the per-group percentage.
+# The language is the one langdetect found, or the script of text that was decided without it.
+def english_dominance(text, threshold=0.8, confidence=0.9):
+    decided = script_prefilter(text)
+    if decided is not None:
+        return decided, 'en' if decided else script_language(text)
+
+    language = script_language(text)
+    if language is None:
+        try:
+            languages = detect_langs(text)
+            english_probability = sum(lang.prob for lang in languages if lang.lang == 'en')
+            language = languages[0].lang if languages else None
+        except Exception:
+            english_probability = None
+
+        if english_probability is not None:
+            if english_probability >= confidence:
+                return True, language
+            if english_probability <= 1 - confidence:
+                return False, language
+
     english_percentage = calculate_english_percentage(text)
-    return english_percentage >= threshold
+    return english_percentage >= threshold, language
+
+# Determines if the text is predominantly English
+def is_english_dominant(text, threshold=0.8, confidence=0.9):
+    return english_dominance(text, threshold, confidence)[0]
 
 
 # Find the translation for the text
@@ -96,57 +228,309 @@ def find_translation(trans):
     if is_english_dominant(trans):
         return trans
 
-    limit = 4800
-    exception_count_trans = 0
-
-    with ThreadPoolExecutor(max_workers=8) as executor:
+    return translate_text(trans)
+
+# Translate a text of any length, splitting it when it is over the character limit
+def translate_text(trans, limit=4800):
+    if len(trans) <= limit:
+        return translate(get_translator(), trans)
+    return translate_chunks(trans, limit)
+
+# Split a text into chunks of at most `limit` characters, on sentence boundaries where possible,
+# then on whitespace, and only inside a word when a single word is longer than the limit.
+# Chunks keep the whitespace that follows them, so joining them gives back the text unchanged.
+def split_text(text, limit=4800):
+    # Sentences end at . ! ? followed by whitespace, or at the CJK 。！？ which are often not followed by any
+    parts = re.split(r'((?<=[.!?])\s+|(?<=[\u3002\uff01\uff1f])\s*)', text)
+    sentences = [parts[i] + (parts[i + 1] if i + 1 < len(parts) else '') for i in range(0, len(parts), 2)]
+
+    pieces = []
+    for sentence in sentences:
+        if len(sentence) <= limit:
+            pieces.append(sentence)
+            continue
+
+        for word in re.findall(r'^\s+|\S+\s*', sentence):
+            pieces.extend(word[i:i + limit] for i in range(0, len(word), limit))
+
+    chunks = []
+    chunk = ""
+    for piece in pieces:
+        if chunk and len(chunk) + len(piece) > limit:
+            chunks.append(chunk)
+            chunk = piece
+        else:
+            chunk += piece
+    if chunk:
+        chunks.append(chunk)
+
+    return chunks
+
+# Threads shared by the chunks of every long text, so long texts translated at the same time by the
+# pipeline or the batch workers stay within one budget. Created on first use.
+CHUNK_WORKERS = 8
+chunk_executor = None
+chunk_executor_lock = threading.Lock()
+
+def get_chunk_executor():
+    global chunk_executor
+    with chunk_executor_lock:
+        if chunk_executor is None:
+            chunk_executor = ThreadPoolExecutor(max_workers=CHUNK_WORKERS)
+        return chunk_executor
+
+# Translate a text longer than the limit: its chunks are translated concurrently and joined in order,
+# each followed by the whitespace that followed it in the text, so line and paragraph breaks survive
+def translate_chunks(trans, limit=4800):
+    chunks = split_text(trans, limit)
+
+    def translate_chunk(chunk):
+        return translate(get_translator(), chunk.strip())
+
+    translated_chunks = list(get_chunk_executor().map(translate_chunk, chunks))
+
+    if any(not text or text == "Translation Error" for text in translated_chunks):
+        return "Translation Error"
+
+    # Chunks cut without whitespace, e.g. after 。, are joined with a space in the translation
+    separators = [chunk[len(chunk.rstrip()):] or " " for chunk in chunks[:-1]] + [""]
+    return "".join(text + separator for text, separator in zip(translated_chunks, separators))
+
+# Separator between packed texts. Texts containing it are never packed.
+PACK_SEPARATOR = '\n'
+# Every packed text starts with its position in the pack, e.g. '[3] ', so each translated line can be matched to its text
+PACK_MARKER = re.compile(r'^\s*\[(\d+)\]\s*(.*)$')
+
+def pack_line(position, text):
+    return f"[{position}] {text}"
+
+# Group texts into packs whose joined length, markers included, stays within the limit
+def pack_texts(texts, limit=4800):
+    packs = []
+    pack = []
+    length = 0
+    for idx, text in texts:
+        line_length = len(pack_line(len(pack) + 1, text))
+        if pack and length + len(PACK_SEPARATOR) + line_length > limit:
+            packs.append(pack)
+            pack = []
+            length = 0
+            line_length = len(pack_line(1, text))
+        length += line_length + (len(PACK_SEPARATOR) if pack else 0)
+        pack.append((idx, text))
+    if pack:
+        packs.append(pack)
+    return packs
+
+# Lines of a packed translation in pack order, None unless every line carries a marker and every
+# position comes back exactly once
+def unpack_lines(translated, count):
+    lines = {}
+    for line in translated.split(PACK_SEPARATOR):
+        if not line.strip():
+            continue
+        match = PACK_MARKER.match(line)
+        if match is None or int(match.group(1)) in lines:
+            return None
+        lines[int(match.group(1))] = match.group(2).strip()
+
+    if sorted(lines) != list(range(1, count + 1)) or not all(lines.values()):
+        return None
+    return [lines[position] for position in range(1, count + 1)]
+
+# Translate several texts with one request, one marked text per line. When the translation does not split
+# back into exactly one marked line per text, every text is translated on its own instead.
+def translate_packed(texts):
+    translator = get_translator()
+
+    if len(texts) == 1:
+        return [translate(translator, texts[0])]
+
+    translated = translate(translator, PACK_SEPARATOR.join(pack_line(position, text) for position, text in enumerate(texts, 1)))
+    if translated and translated != "Translation Error":
+        lines = unpack_lines(translated, len(texts))
+        if lines is not None:
+            return lines
+
+    print(f"Packed translation of {len(texts)} texts did not split back, translating them one by one...")
+    return [translate(translator, text) for text in texts]
+
+# Same results as find_translation for a batch of texts. Short single-line texts that need translation
+# are packed into shared requests up to the character limit, the others are translated on their own.
+# Only texts of the same detected language share a pack, the translator detects one source language per request.
+def find_translations(batch, limit=4800):
+    results = [None] * len(batch)
+    packable = {}
+
+    for idx, trans in enumerate(batch):
+        trans = validate_text(str(trans))
+        if not trans:
+            results[idx] = "Invalid Text"
+            continue
+
+        english, language = english_dominance(trans)
+        if english:
+            results[idx] = trans
+        elif PACK_SEPARATOR in trans or len(trans) > limit:
+            results[idx] = translate_text(trans, limit)
+        else:
+            packable.setdefault(language, []).append((idx, trans))
+
+    for language_texts in packable.values():
+        for pack in pack_texts(language_texts, limit):
+            for (idx, _), translated in zip(pack, translate_packed([text for _, text in pack])):
+                results[idx] = translated
+
+    return results
+
+# Translate a list of texts with I/O-concurrent worker threads, paced by the shared rate limiter.
+# Workers take batches, so texts of a batch can share requests.
+def translate_texts(texts, batch_size=200, workers=16):
+    batches = [texts[i:i + batch_size] for i in range(0, len(texts), batch_size)]
+    results = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for batch_results in tqdm(executor.map(find_translations, batches), total=len(batches), desc='Translating the language'):
+            results.extend(batch_results)
+    return results
+
+
+# Translates fields of rows while they are still being collected. Rows wait in a bounded queue for
+# the worker threads, which add a '{field}_translated' column for every field and hand the row to its sink.
+# put() blocks while the queue is full, so collection slows down to the pace of translation.
+class TranslationPipeline:
+    def __init__(self, fields, workers=8, max_queue=1000):
+        self.fields = fields
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.threads = [threading.Thread(target=self.work, daemon=True) for _ in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    # Queue a row, sink(row) is called with the translated row
+    def put(self, row, sink):
+        self.queue.put((row, sink))
+
+    def work(self):
         while True:
-            if exception_count_trans == 10:
+            task = self.queue.get()
+            if task is None:
+                self.queue.task_done()
                 break
 
+            row, sink = task
+            for field in self.fields:
+                if field not in row:
+                    continue
+                try:
+                    row[field + '_translated'] = find_translation(row[field]) if row[field] is not None else None
+                except Exception as exc:
+                    print(f"Could not translate {field}: {exc}")
+                    row[field + '_translated'] = "Translation Error"
+
+            # The row is passed on even when a translation failed
             try:
-                length = len(trans)
-                if length <= limit:
-                    return translate(translator, trans)
-                else:
-                    return traverse(length, limit, trans, translate, translator)
+                sink(row)
             except Exception as exc:
-                exception_count_trans += 1
-                print("Exception happened while translating the language: ", exc)
-                limit = int(limit / 2)
-
-# Traverses the data (like batches) since there is a characterization limit.
-def traverse(length, limit, trans, function, translator):
-    complete_text = ""
-    loop_count = int(length/limit)
-
-    for i in range(loop_count):
-        text = ""
-        if i == 0:
-            text = function(translator, trans[:limit*(i+1)])
-        elif i == loop_count-1:
-            text = function(translator, trans[limit*(i+1):])
-        else:
-            text = function(translator, trans[limit*i:limit*(i+1)])
+                print(f"Could not save a translated row: {exc}")
+            finally:
+                self.queue.task_done()
+
+    # Wait until every row queued so far has been handed to its sink, the workers keep running
+    def join(self):
+        self.queue.join()
+
+    # Translate the queued rows and stop the workers
+    def close(self):
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+
+# Writer that sends rows through a TranslationPipeline before they reach the wrapped writer.
+# write_rows only returns once its rows are written, so progress recorded right after it stays correct,
+# and raises the first error of the wrapped writer so the caller does not record the rows as saved.
+class TranslatingWriter:
+    def __init__(self, pipeline, writer):
+        self.pipeline = pipeline
+        self.writer = writer
+
+    def write_rows(self, rows):
+        rows = list(rows)
+        if not rows:
+            return
+
+        remaining = [len(rows)]
+        errors = []
+        lock = threading.Lock()
+        written = threading.Event()
+
+        def sink(row):
+            try:
+                self.writer.write(row)
+            except Exception as exc:
+                errors.append(exc)
+            finally:
+                with lock:
+                    remaining[0] -= 1
+                    if remaining[0] == 0:
+                        written.set()
+
+        for row in rows:
+            self.pipeline.put(row, sink)
+        written.wait()
+
+        if errors:
+            raise errors[0]
+
+    def write(self, row):
+        self.write_rows([row])
+
 
-        complete_text += text
+# Translate only the texts that are not in the cache, every distinct text once.
+# Texts are grouped by their normalized form, and the first text of each group is translated.
+def translate_with_cache(texts, cache, dest='en'):
+    keys = [text_key(text, dest) for text in texts]
 
-    return complete_text
+    translations = cache.get_many(set(keys))
 
-def multiprocess_video(attribute, func):
-    with Pool(8) as p:
-        return list(tqdm(p.imap(func, attribute), total=len(attribute), desc='Translating the language'))
+    # One representative text per unseen key
+    pending = {}
+    for key, text in zip(keys, texts):
+        if key not in translations and key not in pending:
+            pending[key] = text
 
+    print(f"Translation cache: {len(texts)} texts, {len(set(keys))} distinct, {len(pending)} to translate.")
+    metrics.inc('translation_cache_lookups_total', len(translations), result='hit')
+    metrics.inc('translation_cache_lookups_total', len(pending), result='miss')
+    metrics.inc('translation_duplicates_total', len(texts) - len(set(keys)))
 
-def translate_en(filename, doc, attribute = 'transcription'):
-    df = pd.read_csv(filename+".csv")
+    if pending:
+        results = dict(zip(pending, translate_texts(list(pending.values()))))
+        translations.update(results)
+
+        # Only real translations are cached, failed ones are retried by the next run
+        cache.put_many({key: result for key, result in results.items()
+                        if isinstance(result, str) and result and result != "Translation Error"}, dest)
+
+    return [translations[key] for key in keys]
+
+
+# Translate a column of '<filename>.csv' (or a '<filename>.parquet' output). With output_format='parquet',
+# the result is written as a typed Parquet file instead of CSV.
+def translate_en(filename, doc, attribute = 'transcription', cache_path='output_data/translation_cache.db', output_format='csv'):
+    if os.path.exists(filename + ".parquet"):
+        df = pd.read_parquet(filename + ".parquet")
+    else:
+        df = pd.read_csv(filename+".csv")
 
     if doc == 'whisper':
         df = df[df[attribute] != 'Not Video']
         df = df[df[attribute].notnull()]
         df.reset_index(drop=True, inplace=True)
 
-    translations = multiprocess_video(df[attribute], find_translation)
+    cache = TranslationCache(cache_path)
+    translations = translate_with_cache(df[attribute].tolist(), cache)
+    cache.close()
     df[attribute] = translations
 
     #trans_filtered_df = df[df[attribute] != "Not English"]
@@ -157,10 +541,13 @@ def translate_en(filename, doc, attribute = 'transcription'):
     no_error_valid_df = valid_df[valid_df[attribute] != "Translation Error"]
     print("Translation Errors are Dropped:", len(valid_df) - len(no_error_valid_df))
 
-    no_error_valid_df.to_csv(filename + "_translated.csv", index=False)
+    if output_format == 'parquet':
+        typed_frame(no_error_valid_df).to_parquet(filename + "_translated.parquet", index=False, compression='zstd')
+    else:
+        no_error_valid_df.to_csv(filename + "_translated.csv", index=False)
 
     return no_error_valid_df
-translator = create_translator()
+rate_limiter = AdaptiveRateLimiter()
 # Ensure consistent results
 DetectorFactory.seed = 0
 
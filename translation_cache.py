@@ -0,0 +1,51 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import unicodedata
+
+
+# Normalize a text for cache lookups: Unicode NFC and collapsed whitespace
+def normalize_text(text):
+    return ' '.join(unicodedata.normalize('NFC', str(text)).split())
+
+
+# Content address of a text and its target language
+def text_key(text, dest='en'):
+    return hashlib.sha256((normalize_text(text) + '\0' + dest).encode('utf-8')).hexdigest()
+
+
+# Persistent SQLite cache of translations keyed by text_key, so a text is only translated once across runs
+class TranslationCache:
+    def __init__(self, path='output_data/translation_cache.db'):
+        self.path = path
+        self.lock = threading.Lock()
+
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS translations (key TEXT PRIMARY KEY, dest TEXT, translation TEXT)")
+
+    # Translations of the keys found in the cache, as key -> translation
+    def get_many(self, keys, chunk_size=500):
+        found = {}
+        keys = list(keys)
+        with self.lock:
+            for i in range(0, len(keys), chunk_size):
+                chunk = keys[i:i + chunk_size]
+                placeholders = ','.join('?' * len(chunk))
+                rows = self.conn.execute(f"SELECT key, translation FROM translations WHERE key IN ({placeholders})", chunk)
+                found.update(rows)
+        return found
+
+    # Store translations given as key -> translation
+    def put_many(self, translations, dest='en'):
+        with self.lock, self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO translations (key, dest, translation) VALUES (?, ?, ?)",
+                                  [(key, dest, translation) for key, translation in translations.items()])
+
+    def close(self):
+        self.conn.close()
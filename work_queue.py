@@ -0,0 +1,168 @@
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+# Attempts after which a task that keeps failing or whose worker keeps dying is given up
+MAX_ATTEMPTS = 5
+
+
+# Default id of a worker process, unique per host and process
+def default_worker_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+# Lease-based work queue in a SQLite file, shared by a coordinator and workers on several hosts.
+# The file must be on storage all hosts can reach and lock (a local disk for workers on one host,
+# or a network filesystem with working locks).
+#   tasks(queue, item_id, payload, status, worker, lease_until, attempts, error, updated)
+#   workers(queue, worker, first_seen, last_seen)   every worker that leased tasks, so their shards can be merged
+# queue is the kind of work ('video', 'channel', 'search'), status is pending, leased, done or failed.
+# A worker leases a batch, renews the lease while it works and completes the tasks. Tasks whose lease
+# expires, e.g. because the worker died, are handed out again.
+class WorkQueue:
+    def __init__(self, path='output_data/work_queue.db', lease_seconds=600, max_attempts=MAX_ATTEMPTS):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+
+        # Autocommit, transactions are opened explicitly so a lease takes the write lock up front
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False, isolation_level=None)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS tasks (queue TEXT, item_id TEXT, payload TEXT, status TEXT, worker TEXT, "
+                          "lease_until REAL, attempts INTEGER DEFAULT 0, error TEXT, updated TEXT, PRIMARY KEY (queue, item_id))")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS tasks_status ON tasks (queue, status, lease_until)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS workers (queue TEXT, worker TEXT, first_seen TEXT, last_seen TEXT, "
+                          "PRIMARY KEY (queue, worker))")
+
+    # Run statements in one write transaction
+    def _transaction(self, func):
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = func()
+                self.conn.execute("COMMIT")
+                return result
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    # Add items as pending tasks. Items are ids or (id, payload dict) pairs, ids already in the queue are skipped.
+    # Returns the number of new tasks.
+    def enqueue(self, queue, items):
+        now = datetime.now().isoformat()
+        rows = []
+        for item in items:
+            item_id, payload = item if isinstance(item, tuple) else (item, None)
+            rows.append((queue, item_id, json.dumps(payload) if payload is not None else None, now))
+
+        def insert():
+            before = self.conn.total_changes
+            self.conn.executemany("INSERT OR IGNORE INTO tasks (queue, item_id, payload, status, updated) "
+                                  "VALUES (?, ?, ?, 'pending', ?)", rows)
+            return self.conn.total_changes - before
+
+        return self._transaction(insert)
+
+    # Lease up to count pending or expired tasks for a worker. Returns [(item_id, payload)].
+    # Expired tasks that already used up their attempts are marked failed instead.
+    def lease(self, queue, worker_id, count):
+        now = time.time()
+
+        def take():
+            self.conn.execute("UPDATE tasks SET status = 'failed', error = 'lease expired too often', updated = ? "
+                              "WHERE queue = ? AND status = 'leased' AND lease_until < ? AND attempts >= ?",
+                              (datetime.now().isoformat(), queue, now, self.max_attempts))
+
+            rows = self.conn.execute("SELECT item_id, payload FROM tasks WHERE queue = ? AND "
+                                     "(status = 'pending' OR (status = 'leased' AND lease_until < ?)) LIMIT ?",
+                                     (queue, now, count)).fetchall()
+            self.conn.executemany("UPDATE tasks SET status = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1, updated = ? "
+                                  "WHERE queue = ? AND item_id = ?",
+                                  [(worker_id, now + self.lease_seconds, datetime.now().isoformat(), queue, item_id)
+                                   for item_id, _ in rows])
+            self.conn.execute("INSERT INTO workers (queue, worker, first_seen, last_seen) VALUES (?, ?, ?, ?) "
+                              "ON CONFLICT (queue, worker) DO UPDATE SET last_seen = excluded.last_seen",
+                              (queue, worker_id, datetime.now().isoformat(), datetime.now().isoformat()))
+            return [(item_id, json.loads(payload) if payload else None) for item_id, payload in rows]
+
+        return self._transaction(take)
+
+    # Extend the lease of every task the worker holds. Returns the number of renewed tasks.
+    def renew(self, queue, worker_id):
+        def extend():
+            cursor = self.conn.execute("UPDATE tasks SET lease_until = ? WHERE queue = ? AND worker = ? AND status = 'leased'",
+                                       (time.time() + self.lease_seconds, queue, worker_id))
+            return cursor.rowcount
+
+        return self._transaction(extend)
+
+    # Renew the leases of the worker every lease_seconds / 3 on a background thread, until stop is set
+    def start_heartbeat(self, queue, worker_id):
+        stop = threading.Event()
+
+        def heartbeat():
+            while not stop.wait(self.lease_seconds / 3):
+                try:
+                    self.renew(queue, worker_id)
+                except sqlite3.Error as e:
+                    print(f"Could not renew the leases of {worker_id}: {e}")
+
+        threading.Thread(target=heartbeat, daemon=True).start()
+        return stop
+
+    # Mark tasks as done
+    def complete(self, queue, item_ids):
+        now = datetime.now().isoformat()
+        self._transaction(lambda: self.conn.executemany(
+            "UPDATE tasks SET status = 'done', lease_until = NULL, updated = ? WHERE queue = ? AND item_id = ?",
+            [(now, queue, item_id) for item_id in item_ids]))
+
+    # Put failed tasks back as pending, or mark them failed once they used up their attempts
+    def fail(self, queue, item_ids, error=''):
+        now = datetime.now().isoformat()
+        self._transaction(lambda: self.conn.executemany(
+            "UPDATE tasks SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, lease_until = NULL, "
+            "error = ?, updated = ? WHERE queue = ? AND item_id = ?",
+            [(self.max_attempts, str(error)[:500], now, queue, item_id) for item_id in item_ids]))
+
+    # Hand tasks back without counting the attempt, e.g. when the worker's keys are exhausted
+    def release(self, queue, item_ids):
+        now = datetime.now().isoformat()
+        self._transaction(lambda: self.conn.executemany(
+            "UPDATE tasks SET status = 'pending', lease_until = NULL, attempts = max(attempts - 1, 0), updated = ? "
+            "WHERE queue = ? AND item_id = ? AND status = 'leased'",
+            [(now, queue, item_id) for item_id in item_ids]))
+
+    # Number of tasks per status, e.g. {'pending': 120, 'leased': 50, 'done': 830}
+    def stats(self, queue):
+        with self.lock:
+            rows = self.conn.execute("SELECT status, count(*) FROM tasks WHERE queue = ? GROUP BY status", (queue,)).fetchall()
+        return dict(rows)
+
+    # True while tasks are pending or leased, i.e. a worker may still get work
+    def has_work(self, queue):
+        stats = self.stats(queue)
+        return stats.get('pending', 0) + stats.get('leased', 0) > 0
+
+    # (item_id, payload, status) of every task of a queue
+    def items(self, queue):
+        with self.lock:
+            rows = self.conn.execute("SELECT item_id, payload, status FROM tasks WHERE queue = ?", (queue,)).fetchall()
+        return [(item_id, json.loads(payload) if payload else None, status) for item_id, payload, status in rows]
+
+    # Ids of every worker that ever leased from a queue
+    def workers(self, queue):
+        with self.lock:
+            rows = self.conn.execute("SELECT worker FROM workers WHERE queue = ?", (queue,)).fetchall()
+        return sorted(row[0] for row in rows)
+
+    def close(self):
+        self.conn.close()
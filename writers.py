@@ -0,0 +1,334 @@
+import os
+import threading
+import uuid
+import pandas as pd
+from metrics import metrics
+
+
+# Buffers rows in memory and appends them to a CSV file in chunks, so memory stays flat
+# no matter how many rows are written. The column layout is fixed by the first chunk.
+# With a journal, a full buffer commits the journal, which flushes every writer before
+# recording progress. Writers sharing a journal also share its lock, so they are thread-safe.
+class CsvRowWriter:
+    def __init__(self, path, chunk_size=1000, unique_key=None, append=False, journal=None):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.unique_key = unique_key
+        self.journal = journal
+        self.lock = journal.lock if journal is not None else threading.RLock()
+        self.buffer = []
+        self.columns = None
+        self.seen = set()
+        self.rows_written = 0
+
+        if journal is not None:
+            journal.add_writer(self)
+
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+
+        if not append and os.path.exists(path):
+            os.remove(path)
+
+        # Continue an existing file with its header and its unique keys
+        if append and os.path.exists(path) and os.path.getsize(path) > 0:
+            self.columns = pd.read_csv(path, nrows=0).columns.tolist()
+            if unique_key in self.columns:
+                for chunk in pd.read_csv(path, usecols=[unique_key], dtype=str, chunksize=100000):
+                    self.seen.update(chunk[unique_key].dropna())
+
+    # Add a single row
+    def write(self, row):
+        with self.lock:
+            if self.unique_key is not None and self.unique_key in row:
+                if row[self.unique_key] in self.seen:
+                    return
+                self.seen.add(row[self.unique_key])
+
+            self.buffer.append(row)
+            metrics.inc('output_rows_total', output=os.path.basename(self.path))
+            if len(self.buffer) >= self.chunk_size:
+                if self.journal is not None:
+                    self.journal.commit()
+                else:
+                    self.flush()
+
+    # Add several rows
+    def write_rows(self, rows):
+        with self.lock:
+            for row in rows:
+                self.write(row)
+
+    # Append the buffered rows to the file
+    def flush(self):
+        with self.lock:
+            if not self.buffer:
+                return
+
+            df = pd.DataFrame(self.buffer)
+            if self.columns is None:
+                self.columns = list(df.columns)
+            else:
+                df = df.reindex(columns=self.columns)
+
+            header = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+            df.to_csv(self.path, mode='a', header=header, index=False)
+
+            self.rows_written += len(self.buffer)
+            self.buffer = []
+
+    # Flush the remaining rows. Creates an empty file if nothing was written.
+    def close(self):
+        self.flush()
+        if not os.path.exists(self.path):
+            open(self.path, 'w').close()
+
+
+# Column types of the typed (Parquet) outputs. Other columns are stored as strings.
+INT_COLUMNS = {'total_views', 'total_likes', 'total_dislikes', 'total_comments', 'total_subscribers', 'total_videos',
+               'comment_likes', 'comment_total_replies', 'value'}
+DATE_COLUMNS = {'published_date', 'video_extracted_date', 'joined_date', 'channel_extracted_date', 'extracted_date',
+                'comment_published_date', 'comment_update_date', 'comment_extracted_date', 'snapshot_time'}
+CATEGORY_COLUMNS = {'category', 'location', 'language', 'kind', 'metric'}
+
+
+# Convert the API's strings to int64, UTC timestamp and categorical columns
+def typed_frame(df):
+    df = df.copy()
+    for column in df.columns:
+        if column in INT_COLUMNS:
+            df[column] = pd.to_numeric(df[column], errors='coerce').astype('Int64')
+        elif column in DATE_COLUMNS:
+            df[column] = pd.to_datetime(df[column], utc=True, errors='coerce', format='ISO8601')
+        elif column in CATEGORY_COLUMNS:
+            df[column] = df[column].astype('category')
+    return df
+
+
+# Same interface as CsvRowWriter, for a Parquet dataset directory with typed columns. Every flush adds
+# a compressed part file. With partition_column, rows are partitioned into publish_month=YYYY-MM
+# directories by that date column, so readers can skip the months they do not need.
+class ParquetRowWriter:
+    def __init__(self, path, chunk_size=10000, unique_key=None, append=False, journal=None,
+                 partition_column=None, compression='zstd'):
+        import pyarrow.parquet as pq
+
+        self.path = path
+        self.chunk_size = chunk_size
+        self.unique_key = unique_key
+        self.journal = journal
+        self.partition_column = partition_column
+        self.compression = compression
+        self.lock = journal.lock if journal is not None else threading.RLock()
+        self.buffer = []
+        self.columns = None
+        self.schema = None
+        self.seen = set()
+        self.rows_written = 0
+        self.run_id = uuid.uuid4().hex[:8]
+        self.part = 0
+
+        if journal is not None:
+            journal.add_writer(self)
+
+        if not append and os.path.exists(path):
+            for root, _, files in os.walk(path, topdown=False):
+                for file in files:
+                    os.remove(os.path.join(root, file))
+                os.rmdir(root)
+
+        # Continue an existing dataset with its columns and its unique keys
+        if append and os.path.exists(path):
+            parts = [os.path.join(root, file) for root, _, files in os.walk(path) for file in files if file.endswith('.parquet')]
+            if parts:
+                schema = pq.read_schema(parts[0])
+                self.schema = schema
+                self.columns = [name for name in schema.names if name != 'publish_month']
+                if unique_key in self.columns:
+                    for part in parts:
+                        self.seen.update(pq.read_table(part, columns=[unique_key]).column(0).drop_null().to_pylist())
+
+    # Add a single row
+    def write(self, row):
+        with self.lock:
+            if self.unique_key is not None and self.unique_key in row:
+                if row[self.unique_key] in self.seen:
+                    return
+                self.seen.add(row[self.unique_key])
+
+            self.buffer.append(row)
+            metrics.inc('output_rows_total', output=os.path.basename(self.path))
+            if len(self.buffer) >= self.chunk_size:
+                if self.journal is not None:
+                    self.journal.commit()
+                else:
+                    self.flush()
+
+    # Add several rows
+    def write_rows(self, rows):
+        with self.lock:
+            for row in rows:
+                self.write(row)
+
+    # Write the buffered rows as a new part file
+    def flush(self):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        with self.lock:
+            if not self.buffer:
+                return
+
+            df = pd.DataFrame(self.buffer)
+            if self.columns is None:
+                self.columns = list(df.columns)
+            else:
+                df = df.reindex(columns=self.columns)
+
+            df = typed_frame(df)
+            if self.partition_column is not None:
+                df['publish_month'] = df[self.partition_column].dt.strftime('%Y-%m').fillna('unknown')
+
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            if self.schema is None:
+                self.schema = table.schema
+            if self.partition_column is not None and 'publish_month' not in self.schema.names:
+                # Partition values live in the directory names, not in the files of an existing dataset
+                self.schema = self.schema.append(pa.field('publish_month', pa.string()))
+            if not self.part:
+                # Columns that are empty in the first chunk hold strings later on, and category codes
+                # get one index width for every chunk
+                self.schema = pa.schema([
+                    field.with_type(pa.string()) if pa.types.is_null(field.type)
+                    else field.with_type(pa.dictionary(pa.int32(), field.type.value_type)) if pa.types.is_dictionary(field.type)
+                    else field
+                    for field in self.schema
+                ])
+            table = table.select(self.schema.names).cast(self.schema)
+
+            if self.partition_column is not None:
+                pq.write_to_dataset(table, self.path, partition_cols=['publish_month'], compression=self.compression,
+                                    basename_template=f'part-{self.run_id}-{self.part:05d}-{{i}}.parquet')
+            else:
+                os.makedirs(self.path, exist_ok=True)
+                pq.write_table(table, os.path.join(self.path, f'part-{self.run_id}-{self.part:05d}.parquet'),
+                               compression=self.compression)
+
+            self.part += 1
+            self.rows_written += len(self.buffer)
+            self.buffer = []
+
+    # Flush the remaining rows. Creates an empty dataset directory if nothing was written.
+    def close(self):
+        self.flush()
+        os.makedirs(self.path, exist_ok=True)
+
+
+# Open the writer of an output without extension: '<path>.csv' or a '<path>.parquet' dataset directory.
+# partition_column is only used by Parquet outputs with partition_by_month.
+def open_row_writer(path, output_format='csv', partition_column=None, partition_by_month=False, **kwargs):
+    if output_format == 'parquet':
+        return ParquetRowWriter(path + '.parquet', partition_column=partition_column if partition_by_month else None, **kwargs)
+    return CsvRowWriter(path + '.csv', **kwargs)
+
+
+# Path of an existing output without extension, preferring the given format
+def output_path(path, output_format='csv'):
+    preferred = path + ('.parquet' if output_format == 'parquet' else '.csv')
+    other = path + ('.csv' if output_format == 'parquet' else '.parquet')
+    return preferred if os.path.exists(preferred) or not os.path.exists(other) else other
+
+
+# Column names of a CSV file or Parquet dataset, empty when it does not exist
+def output_columns(path):
+    if not os.path.exists(path):
+        return []
+    if path.endswith('.parquet'):
+        import pyarrow.dataset as ds
+        return ds.dataset(path, format='parquet', partitioning='hive').schema.names
+    if os.path.getsize(path) == 0:
+        return []
+    return pd.read_csv(path, nrows=0).columns.tolist()
+
+
+# Read columns of a CSV file or Parquet dataset in chunks, as strings
+def read_output_chunks(path, columns, chunk_size=100000):
+    if not output_columns(path):
+        return
+
+    if path.endswith('.parquet'):
+        import pyarrow.dataset as ds
+        dataset = ds.dataset(path, format='parquet', partitioning='hive')
+        for batch in dataset.to_batches(columns=columns, batch_size=chunk_size):
+            chunk = batch.to_pandas()
+            for column in chunk.columns:
+                # Timestamps in the API's format, so they compare with publishedAt values
+                if pd.api.types.is_datetime64_any_dtype(chunk[column]):
+                    chunk[column] = chunk[column].dt.strftime('%Y-%m-%dT%H:%M:%SZ')
+                chunk[column] = chunk[column].astype(object).where(chunk[column].notna(), '').astype(str)
+            yield chunk
+    else:
+        yield from pd.read_csv(path, usecols=columns, dtype=str, keep_default_na=False, chunksize=chunk_size)
+
+
+# Combine CSV files or Parquet datasets, e.g. the shards of several workers, into one output.
+# Rows whose unique_key was already written are skipped. Returns the number of rows written.
+def merge_outputs(paths, merged_path, output_format='csv', unique_key=None, partition_column=None, partition_by_month=False,
+                  chunk_size=100000):
+    writer = open_row_writer(merged_path, output_format, partition_column, partition_by_month, unique_key=unique_key,
+                             chunk_size=chunk_size)
+
+    for path in paths:
+        columns = output_columns(path)
+        # Hive partition columns are part of the directory names, not of the rows
+        columns = [column for column in columns if column != 'publish_month']
+        for chunk in read_output_chunks(path, columns, chunk_size):
+            writer.write_rows(chunk.to_dict('records'))
+
+    writer.close()
+    return writer.rows_written
+
+
+# Join the comment_display of every video into one row per video, reading the comment file in chunks
+def combine_comments(comment_path, combined_path, chunk_size=100000):
+    combined = {}
+
+    for chunk in read_output_chunks(comment_path, ['video_id', 'comment_display'], chunk_size):
+        for video_id, comment in zip(chunk['video_id'], chunk['comment_display']):
+            combined.setdefault(video_id, []).append(comment)
+
+    df_combined_comments = pd.DataFrame({
+        'video_id': sorted(combined),
+        'comment_display': [' '.join(combined[video_id]) for video_id in sorted(combined)]
+    })
+    if combined_path.endswith('.parquet'):
+        df_combined_comments.to_parquet(combined_path, index=False, compression='zstd')
+    else:
+        df_combined_comments.to_csv(combined_path, index=False)
+
+
+# Newest top-level comment of every video in an earlier comment file, as video_id -> (published_at, comment_id).
+# Needs the comment_id and comment_published_date columns. Used to collect only the comments added since.
+def read_latest_comments(comment_path, chunk_size=100000):
+    latest = {}
+
+    columns = output_columns(comment_path)
+    if not columns:
+        return latest
+
+    if 'comment_id' not in columns or 'comment_published_date' not in columns:
+        print(f"{comment_path} has no comment_id and comment_published_date columns, collecting all comments.")
+        return latest
+
+    usecols = ['video_id', 'comment_id', 'comment_published_date'] + (['parent_id'] if 'parent_id' in columns else [])
+    for chunk in read_output_chunks(comment_path, usecols, chunk_size):
+        # Replies are not part of the commentThreads order
+        if 'parent_id' in chunk:
+            chunk = chunk[chunk['parent_id'] == '']
+
+        for video_id, comment_id, published_at in zip(chunk['video_id'], chunk['comment_id'], chunk['comment_published_date']):
+            if video_id not in latest or published_at > latest[video_id][0]:
+                latest[video_id] = (published_at, comment_id)
+
+    return latest
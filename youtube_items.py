@@ -0,0 +1,192 @@
+from datetime import datetime, timedelta
+import isodate
+
+# Conversion of YouTube Data API items into output rows. Shared by the thread-pool and asyncio collectors.
+
+# Split a list into chunks of the given size (videos().list accepts up to 50 ids per call)
+def chunk_list(items, size=50):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+# Parse 'YYYY-MM-DD' start and end dates into datetimes. The end date is inclusive.
+def parse_date_range(start_date, end_date):
+    if isinstance(start_date, str):
+        start_date = datetime.strptime(start_date, '%Y-%m-%d')
+    if isinstance(end_date, str):
+        end_date = datetime.strptime(end_date, '%Y-%m-%d') + timedelta(days=1) - timedelta(seconds=1)
+    return start_date, end_date
+
+# Check whether a publishedAt timestamp falls within the date range
+def in_date_range(published_at, start_date, end_date):
+    if start_date is None and end_date is None:
+        return True
+
+    start_date, end_date = parse_date_range(start_date, end_date)
+    published_date = datetime.strptime(published_at[:19], "%Y-%m-%dT%H:%M:%S")
+
+    if start_date and published_date < start_date:
+        return False
+
+    if end_date and published_date > end_date:
+        return False
+
+    return True
+
+# Convert a video item returned by videos().list into the requested attributes
+def build_video_details(item, fetch_attrs, video_categories):
+    video_details = {}
+
+    if fetch_attrs.get('title', False):
+        video_details['title'] = item['snippet']['title']
+
+    if fetch_attrs.get('description', False):
+        video_details['description'] = item['snippet']['description']
+
+    if fetch_attrs.get('published_date', False):
+        video_details['published_date'] = item['snippet']['publishedAt']
+
+    if fetch_attrs.get('channel_id', False):
+        video_details['channel_id'] = item['snippet']['channelId']
+
+    if fetch_attrs.get('category', False):
+        # Convert category id to category name
+        category_id = item['snippet']['categoryId']
+        video_details['category'] = video_categories.get(category_id, 'Unknown')
+
+    if fetch_attrs.get('duration', False):
+        video_details['duration'] = isodate.parse_duration(item['contentDetails']['duration']).total_seconds()
+
+    if fetch_attrs.get('total_views', False):
+        video_details['total_views'] = item['statistics'].get('viewCount', '0')
+
+    if fetch_attrs.get('total_likes', False):
+        video_details['total_likes'] = item['statistics'].get('likeCount', '0')
+
+    if fetch_attrs.get('total_dislikes', False):
+        video_details['total_dislikes'] = item['statistics'].get('dislikeCount', '0')
+
+    if fetch_attrs.get('total_comments', False):
+        video_details['total_comments'] = item['statistics'].get('commentCount', '0')
+
+    if fetch_attrs.get('video_extracted_date', False):
+        video_details['video_extracted_date'] = datetime.now().isoformat()
+
+    if fetch_attrs.get('thumbnail', False):
+        video_details['thumbnail'] = item['snippet']['thumbnails']['high']['url']
+
+    if fetch_attrs.get('topic_categories', False):
+        topic_categories = item.get('topicDetails', {}).get('topicCategories', [])
+        video_details['topic_categories'] = ', '.join(topic_categories)
+
+    return video_details
+
+# Convert a comment resource (a top-level comment or a reply) into the requested attributes
+def build_comment_fields(comment, comment_attrs, total_replies):
+    comment_dict = {}
+
+    if comment_attrs.get('comment_id', False):
+        comment_dict['comment_id'] = comment['id']
+    if comment_attrs.get('commenter_name', False):
+        comment_dict['commenter_name'] = comment['snippet']['authorDisplayName']
+    if comment_attrs.get('commenter_id', False):
+        if 'authorChannelId' in comment['snippet']:
+            comment_dict['commenter_id'] = comment['snippet']['authorChannelId']['value']
+        else:
+            comment_dict['commenter_id'] = None
+    if comment_attrs.get('comment_display', False):
+        comment_dict['comment_display'] = comment['snippet']['textDisplay']
+    if comment_attrs.get('comment_original', False):
+        comment_dict['comment_original'] = comment['snippet']['textOriginal']
+    if comment_attrs.get('comment_likes', False):
+        comment_dict['comment_likes'] = comment['snippet']['likeCount']
+    if comment_attrs.get('comment_total_replies', False):
+        comment_dict['comment_total_replies'] = total_replies
+    if comment_attrs.get('comment_published_date', False):
+        comment_dict['comment_published_date'] = comment['snippet']['publishedAt']
+    if comment_attrs.get('comment_update_date', False):
+        comment_dict['comment_update_date'] = comment['snippet']['updatedAt']
+    if comment_attrs.get('comment_extracted_date', False):
+        comment_dict['comment_extracted_date'] = datetime.now().isoformat()
+
+    return comment_dict
+
+# Convert a comment thread returned by commentThreads().list into the requested attributes.
+# With include_replies, a parent_id column (None for top-level comments) links replies to their thread.
+def build_comment_details(item, comment_attrs, channel_id, include_replies=False):
+    comment = item["snippet"]["topLevelComment"]
+    comment_dict = build_comment_fields(comment, comment_attrs, item['snippet']['totalReplyCount'])
+
+    if include_replies:
+        comment_dict['parent_id'] = None
+
+    # Add channel_id to the comment dict
+    comment_dict['channel_id'] = channel_id
+    return comment_dict
+
+# Convert a reply returned by comments().list (or inline in a comment thread) into the requested attributes
+def build_reply_details(reply, comment_attrs, channel_id):
+    comment_dict = build_comment_fields(reply, comment_attrs, 0)
+    comment_dict['parent_id'] = reply['snippet']['parentId']
+
+    # Add channel_id to the comment dict
+    comment_dict['channel_id'] = channel_id
+    return comment_dict
+
+# Check if a comment thread is the newest comment known from an earlier run, or older than it.
+# since is a (published_at, comment_id) pair, the threads must be ordered by time.
+def is_known_comment(item, since):
+    published_at, comment_id = since
+    return item['id'] == comment_id or item['snippet']['topLevelComment']['snippet']['publishedAt'] < published_at
+
+# Convert a channel item returned by channels().list into the requested attributes
+def build_channel_details(channel, channel_id, channel_attrs):
+    channel_details = {}
+
+    if channel_attrs.get('channel_id', False):
+        channel_details['channel_id'] = channel_id
+    if channel_attrs.get('channel_title', False):
+        channel_details['channel_title'] = channel['snippet']['title']
+    if channel_attrs.get('description', False):
+        channel_details['description'] = channel['snippet']['description']
+    if channel_attrs.get('joined_date', False):
+        channel_details['joined_date'] = channel['snippet']['publishedAt']
+    if channel_attrs.get('location', False):
+        channel_details['location'] = channel['snippet'].get('country', 'Unknown')
+    if channel_attrs.get('total_subscribers', False):
+        channel_details['total_subscribers'] = channel['statistics']['subscriberCount']
+    #if channel_attrs.get('total_views', False):
+        #channel_details['total_views'] = channel['statistics']['viewCount']
+    if channel_attrs.get('total_videos', False):
+        channel_details['total_videos'] = channel['statistics']['videoCount']
+    if channel_attrs.get('extracted_date', False):
+        channel_details['extracted_date'] = datetime.now().isoformat()
+    if channel_attrs.get('thumbnail', False):
+        channel_details['thumbnail'] = channel['snippet']['thumbnails']['high']['url']
+    if channel_attrs.get('language', False):
+        channel_details['language'] = channel.get('snippet', {}).get('defaultLanguage', 'Unknown')
+    if channel_attrs.get('channel_extracted_date', False):
+        channel_details['channel_extracted_date'] = datetime.now().isoformat()
+    if channel_details.get('topic_categories', False):
+        topic_categories = channel.get('topicDetails', {}).get('topicCategories', [])
+        channel_details['topic_categories'] = ', '.join(topic_categories)
+
+    return channel_details
+
+# Output names of the statistics returned with part=statistics
+STATISTICS_METRICS = {
+    'video': {'viewCount': 'total_views', 'likeCount': 'total_likes', 'dislikeCount': 'total_dislikes', 'commentCount': 'total_comments'},
+    'channel': {'viewCount': 'total_views', 'subscriberCount': 'total_subscribers', 'videoCount': 'total_videos'},
+}
+
+# Convert the statistics of a video or channel item into long-format time-series rows, one per metric
+def build_statistics_rows(item, kind, snapshot_time):
+    rows = []
+    for field, metric in STATISTICS_METRICS[kind].items():
+        if field in item.get('statistics', {}):
+            rows.append({
+                'snapshot_time': snapshot_time,
+                'kind': kind,
+                'id': item['id'],
+                'metric': metric,
+                'value': int(item['statistics'][field])
+            })
+    return rows